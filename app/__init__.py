@@ -2,20 +2,39 @@ import logging
 from flask import Flask
 from flask_migrate import Migrate
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 from sqlalchemy.exc import SQLAlchemyError
 from app.models import db
 from app.common.exceptions import InvalidUsage
+from app.common.cache import credential_cache, polygon_cache, response_cache
+from app.common.hashing import password_hasher
+from app.common.ratelimit import login_limiter
+from app.utils.spatial import marker_indexes
 
 
 def create_app(config):
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_pyfile('config.py')
     app.config.from_object(config)
+    if app.config.get('PROXY_FIX_X_FOR'):
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
 
     # Load extensions
     db.init_app(app)
-    CORS(app)
+    CORS(app, expose_headers=['X-Next-Cursor', 'X-Total-Count', 'ETag'])
     Migrate(app, db)
+    credential_cache.init_app(app)
+    polygon_cache.init_app(app)
+    response_cache.init_app(app)
+    password_hasher.init_app(app)
+    login_limiter.init_app(app)
+    marker_indexes.init_app(app)
+
+    # Load commands
+    from app.commands import calibrate_hashing, rebuild_aggregates, markers
+    app.cli.add_command(calibrate_hashing)
+    app.cli.add_command(rebuild_aggregates)
+    app.cli.add_command(markers)
 
     # Exception handling
     @app.errorhandler(InvalidUsage)
@@ -0,0 +1,137 @@
+import json
+import os
+import time
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from passlib.context import CryptContext
+from passlib.registry import get_crypt_handler
+from sqlalchemy import and_, or_, bindparam, func, select
+from app.common.hashing import password_hasher
+from app.models import db, Marker
+from app.utils import aggregates, geometry
+
+CALIBRATION_PROBE_ROUNDS = 100000
+
+
+def measure_rounds(scheme: str, target_seconds: float, samples=3) -> int:
+    """ Estimate the rounds `scheme` needs to take `target_seconds` per hash. """
+    handler = get_crypt_handler(scheme).using(rounds=CALIBRATION_PROBE_ROUNDS)
+    elapsed = float('inf')
+    for _ in range(samples):
+        start = time.perf_counter()
+        handler.hash('calibration')
+        elapsed = min(elapsed, time.perf_counter() - start)
+    rounds = int(CALIBRATION_PROBE_ROUNDS * target_seconds / elapsed)
+    return rounds
+
+
+def clamp_rounds(scheme: str, rounds: int) -> int:
+    handler = get_crypt_handler(scheme)
+    rounds = max(handler.min_rounds, min(handler.max_rounds, rounds))
+    return rounds - rounds % 1000 if rounds > 1000 else rounds
+
+
+@click.command('calibrate-hashing')
+@click.option('--target-ms', default=250, help='Target time to verify one password.')
+@click.option('--admin-factor', default=2.0, help='Extra cost for admin accounts.')
+@click.option('--output', default=None,
+              help='Where to write the passlib config, defaults to instance/passlib.ini.')
+@with_appcontext
+def calibrate_hashing(target_ms, admin_factor, output):
+    """ Benchmark password hashing and write a passlib config for this machine. """
+    current = CryptContext.from_string(password_hasher.config)
+    settings = {
+        'schemes': current.schemes(),
+        'default': current.default_scheme()
+    }
+    for scheme in current.schemes():
+        rounds = measure_rounds(scheme, target_ms / 1000)
+        user_rounds = clamp_rounds(scheme, rounds)
+        admin_rounds = clamp_rounds(scheme, int(rounds * admin_factor))
+        settings[scheme + '__default_rounds'] = user_rounds
+        settings[scheme + '__min_rounds'] = user_rounds
+        settings['admin__' + scheme + '__default_rounds'] = admin_rounds
+        settings['admin__' + scheme + '__min_rounds'] = admin_rounds
+        click.echo('{}: {} rounds ({} for admin)'.format(scheme, user_rounds, admin_rounds))
+
+    if output is None:
+        os.makedirs(current_app.instance_path, exist_ok=True)
+        output = os.path.join(current_app.instance_path, 'passlib.ini')
+    with open(output, 'w') as f:
+        f.write(CryptContext(**settings).to_string())
+    click.echo('Written to {}, point PASSLIB_CONTEXT_PATH at it to apply.'.format(output))
+    click.echo('Existing hashes are upgraded on the next successful login.')
+
+
+@click.command('rebuild-aggregates')
+@click.option('--check', is_flag=True, help='Only compare the stored aggregates with a recompute.')
+@with_appcontext
+def rebuild_aggregates(check):
+    """ Recompute the project aggregates from scratch. """
+    connection = db.session.connection()
+    differences = aggregates.differences(connection)
+    for (scope, name), stored, expected in differences:
+        click.echo('{} {!r}: stored {}, expected {}'.format(scope, name, stored, expected))
+    if check:
+        db.session.rollback()
+        if differences:
+            raise click.ClickException('{} aggregates out of date'.format(len(differences)))
+        click.echo('Aggregates are up to date.')
+        return
+
+    aggregates.rebuild(connection)
+    db.session.commit()
+    click.echo('Aggregates rebuilt, {} were out of date.'.format(len(differences)))
+
+
+@click.group('markers')
+def markers():
+    """ Marker maintenance. """
+
+
+@markers.command('migrate')
+@click.option('--batch-size', default=1000, help='Markers converted per transaction.')
+@with_appcontext
+def migrate_markers(batch_size):
+    """
+    Convert polygons still stored as JSON text to the packed format and
+    fill in the centre and bounding box columns.
+    """
+    table = Marker.__table__
+    derived = ('centre_x', 'centre_y', 'min_x', 'min_y', 'max_x', 'max_y')
+    update = table.update().where(table.c.id == bindparam('marker_id')).values(
+        polygon_blob=bindparam('blob'), polygon_json=None,
+        **{column: bindparam('new_' + column) for column in derived})
+    pending = or_(
+        and_(table.c.polygon_blob.is_(None), table.c.polygon_json.isnot(None)),
+        and_(table.c.min_x.is_(None), func.length(table.c.polygon_blob) > 0))
+
+    last_id, converted, failed = 0, 0, 0
+    while True:
+        rows = db.session.execute(
+            select([table.c.id, table.c.polygon_blob, table.c.polygon_json])
+            .where(and_(table.c.id > last_id, pending))
+            .order_by(table.c.id)
+            .limit(batch_size)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        values = []
+        for marker_id, polygon_blob, polygon_json in rows:
+            try:
+                blob = polygon_blob if polygon_blob is not None \
+                    else geometry.pack(json.loads(polygon_json))
+            except (ValueError, KeyError, TypeError, OverflowError):
+                click.echo('Marker {} has an invalid polygon, left as JSON'.format(marker_id))
+                failed += 1
+                continue
+            columns = geometry.derived_columns(geometry.unpack(blob))
+            values.append(dict(
+                marker_id=marker_id, blob=blob,
+                **{'new_' + column: value for column, value in columns.items()}))
+        if values:
+            db.session.execute(update, values)
+        db.session.commit()
+        converted += len(values)
+    click.echo('{} markers converted, {} left as JSON.'.format(converted, failed))
@@ -1,8 +1,10 @@
-from flask import g
+from flask import g, current_app, request
 from functools import wraps
 from itsdangerous import SignatureExpired, BadSignature
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth, MultiAuth
-from app.models import User
+from app.models import db, User
+from app.common.cache import credential_cache
+from app.common.ratelimit import login_limiter
 from app.common.exceptions import InvalidUsage
 
 
@@ -19,6 +21,34 @@ class ForbiddenException(InvalidUsage):
         super().__init__('Forbidden', 403)
 
 
+class TokenUser:
+    """
+    Stand-in for the authenticated User built from token claims. `id` and
+    `is_admin` come from the token, any other attribute loads the row.
+    """
+
+    def __init__(self, claims):
+        self.id = claims['id']
+        self.is_admin = claims['adm']
+        self._claims = claims
+        self._user = None
+
+    @staticmethod
+    def accepts(claims) -> bool:
+        return 'adm' in claims and 'ver' in claims
+
+    def _get_current_object(self) -> User:
+        if self._user is None:
+            user = User.query.get(self.id)
+            if not user or not user.matches_token(self._claims):
+                raise UnauthorizedException()
+            self._user = user
+        return self._user
+
+    def __getattr__(self, name):
+        return getattr(self._get_current_object(), name)
+
+
 class Auth(MultiAuth):
     def __init__(self):
         self.basic_auth = HTTPBasicAuth()
@@ -28,9 +58,17 @@ class Auth(MultiAuth):
         def verify_password(email: str, password: str) -> bool:
             if not email:
                 return False
+            login_limiter.check(email, request.remote_addr)
             user = User.query.filter_by(email=email).first()
-            if not user or not user.verify_password(password):
+            if not user:
                 return False
+            if not credential_cache.check(user, password):
+                if not user.verify_password(password):
+                    return False
+                if db.session.is_modified(user):
+                    db.session.commit()
+                credential_cache.add(user, password)
+            login_limiter.refund(email)
             g.user = user
             return True
 
@@ -41,9 +79,15 @@ class Auth(MultiAuth):
         @self.token_auth.verify_token
         def verify_token(token: str) -> bool:
             try:
-                user = User.verify_token(token)
+                claims = User.load_token(token)
             except (SignatureExpired, BadSignature):
                 return False
+            if current_app.config.get('STATELESS_TOKEN_AUTH') and TokenUser.accepts(claims):
+                g.user = TokenUser(claims)
+                return True
+            user = User.query.get(claims['id'])
+            if not user or not user.matches_token(claims):
+                return False
             g.user = user
             return True
 
@@ -57,6 +101,12 @@ class Auth(MultiAuth):
     def current_user(self) -> User:
         return g.user
 
+    def load_current_user(self) -> User:
+        """ Return the User row, loading it if only token claims are known. """
+        if isinstance(g.user, TokenUser):
+            return g.user._get_current_object()
+        return g.user
+
     def admin_required(self, f):
         @wraps(f)
         @self.login_required
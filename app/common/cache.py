@@ -0,0 +1,180 @@
+import hmac
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from hashlib import sha256
+
+
+class TTLCache:
+    """ Thread-safe LRU cache whose entries also expire after `ttl` seconds. """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return entry[0] if entry else None
+
+    def evict(self, predicate):
+        """ Drop the entries whose key matches `predicate`. """
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+
+class CredentialCache:
+    """
+    Remember successful password verifications so repeated Basic auth
+    requests skip the expensive hash. Passwords are never stored, only an
+    HMAC keyed with a per-process secret.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self._entries = TTLCache(maxsize, ttl)
+        self._key = secrets.token_bytes(32)
+
+    def init_app(self, app):
+        self._entries = TTLCache(
+            app.config.get('CREDENTIAL_CACHE_SIZE', 1024),
+            app.config.get('CREDENTIAL_CACHE_TTL', 300))
+
+    def _digest(self, password: str) -> bytes:
+        return hmac.new(self._key, password.encode('utf-8'), sha256).digest()
+
+    def check(self, user, password: str) -> bool:
+        entry = self._entries.get(user.id)
+        if entry is None:
+            return False
+        digest, password_hash = entry
+        # the stored hash guards against password changes made by other workers
+        return hmac.compare_digest(digest, self._digest(password)) and \
+            password_hash == user.password_hash
+
+    def add(self, user, password: str):
+        self._entries.set(user.id, (self._digest(password), user.password_hash))
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id)
+
+    def stats(self):
+        return self._entries.stats()
+
+
+class PolygonCache:
+    """
+    Simplified marker polygons per marker and tolerance bucket. Entries
+    remember the stored polygon they were computed from, so changes made
+    by other workers are noticed as well.
+    """
+
+    def __init__(self, maxsize=4096):
+        self._entries = TTLCache(maxsize)
+
+    def init_app(self, app):
+        self._entries = TTLCache(app.config.get('POLYGON_CACHE_SIZE', 4096))
+
+    def get(self, marker_id, source, bucket, compute):
+        entry = self._entries.get(marker_id)
+        if entry is None or entry[0] != source:
+            entry = (source, {})
+            self._entries.set(marker_id, entry)
+        versions = entry[1]
+        if bucket not in versions:
+            versions[bucket] = compute()
+        return versions[bucket]
+
+    def invalidate(self, marker_id):
+        self._entries.pop(marker_id)
+
+    def stats(self):
+        return self._entries.stats()
+
+
+class ResponseCache:
+    """
+    Serialized GET responses, grouped by the change counter covering them
+    ('map' or 'marker:<map_id>'). Keys include the version the response was
+    built from, read from the database on every request, so writes made by
+    other workers are never served; commits in this worker drop their
+    groups right away to free the memory.
+    """
+
+    def __init__(self, maxsize=128):
+        self._entries = TTLCache(maxsize)
+
+    def init_app(self, app):
+        self._entries = TTLCache(app.config.get('RESPONSE_CACHE_SIZE', 128))
+
+    def get(self, group, key, version, compute):
+        cache_key = (group, key, version)
+        data = self._entries.get(cache_key)
+        if data is None:
+            data = compute()
+            self._entries.set(cache_key, data)
+        return data
+
+    def invalidate(self, groups):
+        """ Drop `groups`, 'marker:*' standing for every marker group. """
+        groups = set(groups)
+        if 'marker:*' in groups:
+            self._entries.evict(lambda key: key[0].startswith('marker:') or key[0] in groups)
+        else:
+            self._entries.evict(lambda key: key[0] in groups)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return self._entries.stats()
+
+
+credential_cache = CredentialCache()
+polygon_cache = PolygonCache()
+response_cache = ResponseCache()
@@ -0,0 +1,27 @@
+import json
+from hashlib import sha1
+from flask import request, Response
+from werkzeug.http import quote_etag
+from app.common.auth import auth
+
+
+def list_etag(*validator):
+    """
+    Weak ETag value (unquoted) for a list response. Besides the validator
+    it covers what else shapes the payload: the query string and the user.
+    """
+    user = auth.current_user
+    parts = [validator, request.query_string.decode('latin-1'), user.id, user.is_admin]
+    return sha1(json.dumps(parts, default=str).encode('utf-8')).hexdigest()
+
+
+def not_modified(etag):
+    """ The 304 response if the client already holds `etag`, otherwise None. """
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=etag_headers(etag))
+    return None
+
+
+def etag_headers(etag):
+    # clients may reuse the body but must revalidate every time
+    return {'ETag': quote_etag(etag, weak=True), 'Cache-Control': 'private, no-cache'}
@@ -21,3 +21,13 @@ class NotFoundException(InvalidUsage):
         else:
             message = obj.__name__ + ' not found'
         super().__init__(message, 404)
+
+
+class ServiceUnavailableException(InvalidUsage):
+    def __init__(self, message='Service Unavailable', retry_after=1):
+        super().__init__(message, 503, {'Retry-After': str(retry_after)})
+
+
+class TooManyRequestsException(InvalidUsage):
+    def __init__(self, retry_after=1):
+        super().__init__('Too Many Requests', 429, {'Retry-After': str(retry_after)})
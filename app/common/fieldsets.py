@@ -0,0 +1,38 @@
+from collections import OrderedDict
+from flask_restful import reqparse
+from sqlalchemy.orm import load_only
+from app.common.exceptions import InvalidUsage
+
+
+def parse_fieldset(all_fields):
+    """ Return the fields named by `?fields=a,b`, or all of them if absent. """
+    parser = reqparse.RequestParser()
+    parser.add_argument('fields', type=str, location='args')
+    requested = parser.parse_args()['fields']
+    if not requested:
+        return all_fields
+    names = {name.strip() for name in requested.split(',') if name.strip()}
+    unknown = names - set(all_fields)
+    if unknown:
+        raise InvalidUsage('Unknown fields: {}'.format(', '.join(sorted(unknown))))
+    return OrderedDict((key, field) for key, field in all_fields.items() if key in names)
+
+
+def load_fieldset(model, fieldset, depends_on=None, extra=()):
+    """
+    Query option loading only the columns `fieldset` reads, plus `extra`.
+    `depends_on` maps property names to the columns they are computed from.
+    """
+    depends_on = depends_on or {}
+    attributes = set(extra)
+    for key, field in fieldset.items():
+        attribute = getattr(field, 'attribute', None) or key
+        attributes.add(attribute)
+        attributes.update(depends_on.get(attribute, ()))
+    columns = [c.key for c in model.__mapper__.column_attrs if c.key in attributes]
+    return load_only(*columns)
+
+
+def eager_fieldset(fieldset, loaders):
+    """ Loader options from `loaders` for the fields `fieldset` includes. """
+    return [loader for key, loader in loaders.items() if key in fieldset]
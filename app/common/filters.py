@@ -0,0 +1,84 @@
+import sys
+from flask_restful import inputs, reqparse
+from sqlalchemy import DateTime
+
+RANGE_OPERATORS = {
+    'gt': lambda column, value: column > value,
+    'gte': lambda column, value: column >= value,
+    'lt': lambda column, value: column < value,
+    'lte': lambda column, value: column <= value,
+}
+
+
+def escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _prefix_upper_bound(prefix: str):
+    """ Smallest string above every string starting with `prefix`, None if there is none. """
+    # a trailing U+10FFFF cannot be incremented, drop it and carry on
+    stem = prefix.rstrip(chr(sys.maxunicode))
+    if not stem:
+        return None
+    code = ord(stem[-1]) + 1
+    if 0xD800 <= code <= 0xDFFF:
+        # surrogates cannot be encoded for the database
+        code = 0xE000
+    return stem[:-1] + chr(code)
+
+
+def prefix_filter(column, prefix: str):
+    """ `column LIKE 'prefix%'` written as a range so any index can serve it. """
+    upper = _prefix_upper_bound(prefix)
+    if upper is None:
+        return column >= prefix
+    return (column >= prefix) & (column < upper)
+
+
+class FilterSet:
+    """
+    Typed filters parsed from request arguments. Numeric and date columns
+    take `field=value` for equality and `field__gt|gte|lt|lte=value` for
+    ranges. Text columns take `field=prefix`, or `field__contains=value`
+    for a substring match that cannot use an index.
+    """
+
+    def __init__(self, model, numeric=(), text=()):
+        self.model = model
+        self.numeric = numeric
+        self.text = text
+
+    def _numeric_type(self, field):
+        column_type = getattr(self.model, field).type
+        if isinstance(column_type, DateTime):
+            return inputs.datetime_from_iso8601
+        return column_type.python_type
+
+    def parse_args(self):
+        parser = reqparse.RequestParser()
+        for field in self.numeric:
+            value_type = self._numeric_type(field)
+            parser.add_argument(field, type=value_type)
+            for op in RANGE_OPERATORS:
+                parser.add_argument(field + '__' + op, type=value_type)
+        for field in self.text:
+            parser.add_argument(field, type=str)
+            parser.add_argument(field + '__contains', type=str)
+        return parser.parse_args()
+
+    def apply(self, query, args):
+        for key, value in args.items():
+            if value is None or value == '':
+                continue
+            field, _, op = key.partition('__')
+            column = getattr(self.model, field)
+            if not op:
+                if field in self.text:
+                    query = query.filter(prefix_filter(column, value))
+                else:
+                    query = query.filter(column == value)
+            elif op == 'contains':
+                query = query.filter(column.like('%' + escape_like(value) + '%', escape='\\'))
+            else:
+                query = query.filter(RANGE_OPERATORS[op](column, value))
+        return query
@@ -0,0 +1,85 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from passlib.context import CryptContext
+from app.common.exceptions import ServiceUnavailableException
+
+_contexts = {}
+
+
+def _get_context(config: str) -> CryptContext:
+    context = _contexts.get(config)
+    if context is None:
+        context = _contexts[config] = CryptContext.from_string(config)
+    return context
+
+
+def _hash(config, password):
+    return _get_context(config).hash(password)
+
+
+def _verify(config, password, password_hash):
+    return _get_context(config).verify(password, password_hash)
+
+
+def _verify_and_update(config, password, password_hash):
+    return _get_context(config).verify_and_update(password, password_hash)
+
+
+class PasswordHasher:
+    """
+    Run passlib hashing in a process pool so a login storm does not block
+    request threads. With `PASSWORD_HASH_WORKERS = 0` hashing runs inline.
+    """
+
+    def __init__(self):
+        self.config = None
+        self.workers = 0
+        self.queue_limit = 0
+        self._executor = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        if app.config.get('PASSLIB_CONTEXT_PATH'):
+            with open(app.config['PASSLIB_CONTEXT_PATH'], 'r') as f:
+                self.config = f.read()
+        else:
+            self.config = app.config['PASSLIB_CONTEXT_CONFIG']
+        workers = app.config.get('PASSWORD_HASH_WORKERS', 0)
+        if workers != self.workers and self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self.workers = workers
+        self.queue_limit = app.config.get('PASSWORD_HASH_QUEUE_LIMIT', 0)
+        if self.workers and self._executor is None:
+            # fork the workers now, while the app is still single threaded;
+            # forking from a request thread can copy locks held by others
+            self._executor = ProcessPoolExecutor(self.workers)
+            self._executor.submit(int).result()
+
+    def _run(self, fn, *args):
+        executor = self._executor
+        if executor is None:
+            return fn(self.config, *args)
+        with self._lock:
+            if self.queue_limit and self._pending >= self.queue_limit:
+                raise ServiceUnavailableException('Too many password operations in progress')
+            self._pending += 1
+        try:
+            return executor.submit(fn, self.config, *args).result()
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def hash(self, password: str) -> str:
+        return self._run(_hash, password)
+
+    def verify(self, password: str, password_hash: str) -> bool:
+        return self._run(_verify, password, password_hash)
+
+    def verify_and_update(self, password: str, password_hash: str):
+        """ Return (valid, new_hash), new_hash is set if the policy has changed. """
+        return self._run(_verify_and_update, password, password_hash)
+
+
+password_hasher = PasswordHasher()
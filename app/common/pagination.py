@@ -0,0 +1,55 @@
+import base64
+import binascii
+import datetime
+import json
+from sqlalchemy import and_, or_
+from app.common.exceptions import InvalidUsage
+
+
+def encode_cursor(values) -> str:
+    values = [v.isoformat() if isinstance(v, datetime.datetime) else v for v in values]
+    return str(base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')), encoding='utf-8')
+
+
+def decode_cursor(cursor: str, size: int):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+    except (binascii.Error, ValueError):
+        raise InvalidUsage('Invalid cursor')
+    if not isinstance(values, list) or len(values) != size:
+        raise InvalidUsage('Invalid cursor')
+    return values
+
+
+def paginate(query, model, limit, cursor=None, sort='id', with_total=False):
+    """
+    Keyset pagination over `query`, sorted by `sort` and then id. Return
+    (items, next_cursor, total); total is None unless `with_total`.
+    """
+    total = query.order_by(None).count() if with_total else None
+    if sort == 'id':
+        keys = [model.id]
+    else:
+        keys = [getattr(model, sort), model.id]
+
+    if cursor:
+        values = decode_cursor(cursor, len(keys))
+        try:
+            if sort != 'id':
+                values[0] = datetime.datetime.fromisoformat(values[0])
+            values[-1] = int(values[-1])
+        except (TypeError, ValueError):
+            raise InvalidUsage('Invalid cursor')
+        if len(keys) == 1:
+            query = query.filter(keys[0] > values[0])
+        else:
+            query = query.filter(or_(
+                keys[0] > values[0],
+                and_(keys[0] == values[0], keys[1] > values[1])))
+
+    items = query.order_by(*keys).limit(limit + 1).all()
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor([getattr(items[-1], key.key) for key in keys])
+    return items, next_cursor, total
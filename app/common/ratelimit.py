@@ -0,0 +1,106 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from app.common.exceptions import TooManyRequestsException
+
+
+class RateLimitBackend:
+    """ Storage for token buckets, implement this to share buckets across workers. """
+
+    def consume(self, key, capacity, refill_rate, cost=1) -> float:
+        """
+        Take `cost` tokens, return 0 if allowed or seconds to wait otherwise.
+        A negative cost gives tokens back, up to `capacity`.
+        """
+        raise NotImplementedError()
+
+
+class LocalBackend(RateLimitBackend):
+    """ In-memory buckets of this process, idle buckets are evicted. """
+
+    def __init__(self, max_buckets=10000):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()  # key -> (tokens, updated, full_at)
+        self._lock = threading.Lock()
+
+    def consume(self, key, capacity, refill_rate, cost=1) -> float:
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, _ = self._buckets.pop(key, (capacity, now, now))
+            tokens = min(capacity, tokens + (now - updated) * refill_rate)
+            if tokens >= cost:
+                tokens = min(capacity, tokens - cost)
+                retry_after = 0
+            else:
+                retry_after = (cost - tokens) / refill_rate
+            full_at = now + (capacity - tokens) / refill_rate
+            self._buckets[key] = (tokens, now, full_at)
+            self._evict(now)
+        return retry_after
+
+    def _evict(self, now):
+        # buckets are ordered by last use, a refilled bucket equals a new one
+        while self._buckets:
+            key, (_, _, full_at) = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self.max_buckets and full_at > now:
+                break
+            del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class LoginLimiter:
+    """
+    Token buckets per email and per client address, checked before hashing.
+    Successful logins are refunded their email token.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.backend = LocalBackend()
+        self.limits = {}
+
+    def init_app(self, app):
+        self.enabled = app.config.get('LOGIN_RATE_LIMIT_ENABLED', True)
+        backend_factory = app.config.get('LOGIN_RATE_LIMIT_BACKEND')
+        if backend_factory:
+            self.backend = backend_factory()
+        else:
+            self.backend = LocalBackend(app.config.get('LOGIN_RATE_LIMIT_MAX_BUCKETS', 10000))
+        self.limits = {
+            'email': (app.config.get('LOGIN_RATE_LIMIT_EMAIL_BURST', 10),
+                      app.config.get('LOGIN_RATE_LIMIT_EMAIL_PER_MINUTE', 5) / 60),
+            'address': (app.config.get('LOGIN_RATE_LIMIT_ADDRESS_BURST', 100),
+                        app.config.get('LOGIN_RATE_LIMIT_ADDRESS_PER_MINUTE', 60) / 60),
+        }
+
+    @staticmethod
+    def _keys(email: str, address: str):
+        return {'email': email.lower(), 'address': address or ''}
+
+    def check(self, email: str, address: str):
+        if not self.enabled:
+            return
+        retry_after = 0
+        for kind, key in self._keys(email, address).items():
+            capacity, refill_rate = self.limits[kind]
+            retry_after = max(
+                retry_after,
+                self.backend.consume('{}:{}'.format(kind, key), capacity, refill_rate))
+        if retry_after:
+            raise TooManyRequestsException(math.ceil(retry_after))
+
+    def refund(self, email: str):
+        """
+        Give back the email token of a successful login. Address tokens are
+        kept, or one valid account would refill an address spraying others.
+        """
+        if not self.enabled:
+            return
+        capacity, refill_rate = self.limits['email']
+        self.backend.consume('email:{}'.format(email.lower()), capacity, refill_rate, cost=-1)
+
+
+login_limiter = LoginLimiter()
@@ -0,0 +1,134 @@
+from flask_restful import fields as restful_fields, marshal
+from flask_restful.fields import _rfc822, _iso8601
+from app.common.cache import TTLCache
+
+# field types whose output is reproduced inline, `{}` is the fetched value
+_FORMATS = {
+    restful_fields.Raw: '{}',
+    restful_fields.String: 'str({})',
+    restful_fields.Integer: 'int({})',
+    restful_fields.Float: 'float({})',
+    restful_fields.Boolean: 'bool({})',
+}
+
+_serializers = TTLCache(maxsize=256)
+
+
+def _indexable(obj):
+    return not hasattr(obj, 'strip') and hasattr(obj, '__iter__')
+
+
+def _nested_output(field, serialize):
+    """ Same as Nested.output once the value has been fetched. """
+    def output(value):
+        if value is None:
+            if field.allow_null:
+                return None
+            elif field.default is not None:
+                return field.default
+        if isinstance(value, (list, tuple)):
+            return [serialize(v) for v in value]
+        return serialize(value)
+    return output
+
+
+def _list_output(field, nested):
+    """ Same as List(Nested(...)).output once the value has been fetched. """
+    def output(value):
+        if _indexable(value) and not isinstance(value, dict):
+            if isinstance(value, set):
+                value = list(value)
+            return [nested(value[i]) for i in range(len(value))]
+        if value is None:
+            return field.default
+        return [marshal(value, field.container.nested)]
+    return output
+
+
+def _compile_one(fields):
+    """
+    Generate a function marshalling one object with `fields`. Objects or
+    values the inline code does not cover go through flask_restful, so
+    the output and errors are always the same as `marshal`.
+    """
+    namespace = {
+        '_indexable': _indexable,
+        '_marshal': marshal,
+        '_fields': fields,
+        '_rfc822': _rfc822,
+        '_iso8601': _iso8601,
+    }
+    body = []
+    items = []
+    for i, (key, field) in enumerate(fields.items()):
+        result = 'r{}'.format(i)
+        items.append('{!r}: {}'.format(key, result))
+        if isinstance(field, dict):
+            namespace['s{}'.format(i)] = _compile_one(field)
+            body.append('{} = s{}(obj)'.format(result, i))
+            continue
+        if isinstance(field, type):
+            field = field()
+        attribute = key if field.attribute is None else field.attribute
+        if not isinstance(attribute, str) or '.' in attribute:
+            namespace['f{}'.format(i)] = field
+            body.append('{} = f{}.output({!r}, obj)'.format(result, i, key))
+            continue
+
+        fetch = 'v = getattr(obj, {!r}, None)'.format(attribute)
+        namespace['d{}'.format(i)] = field.default
+        field_type = type(field)
+        if field_type in _FORMATS:
+            body.append(fetch)
+            body.append('{} = d{} if v is None else {}'.format(
+                result, i, _FORMATS[field_type].format('v')))
+        elif field_type is restful_fields.DateTime and field.dt_format in ('rfc822', 'iso8601'):
+            body.append(fetch)
+            body.append('{} = d{} if v is None else _{}(v)'.format(result, i, field.dt_format))
+        elif field_type is restful_fields.Nested:
+            namespace['n{}'.format(i)] = _nested_output(field, _compile_one(field.nested))
+            body.append(fetch)
+            body.append('{} = n{}(v)'.format(result, i))
+        elif field_type is restful_fields.List and type(field.container) is restful_fields.Nested:
+            container = field.container
+            nested = _nested_output(container, _compile_one(container.nested))
+            namespace['l{}'.format(i)] = _list_output(field, nested)
+            body.append(fetch)
+            body.append('{} = l{}(v)'.format(result, i))
+        else:
+            namespace['f{}'.format(i)] = field
+            body.append('{} = f{}.output({!r}, obj)'.format(result, i, key))
+
+    source = '\n'.join(
+        ['def serialize(obj):',
+         '    if _indexable(obj):',
+         '        return _marshal(obj, _fields)',
+         '    try:'] +
+        ['        ' + line for line in body] +
+        ['    except Exception:',
+         '        return _marshal(obj, _fields)',
+         '    return {' + ', '.join(items) + '}'])
+    exec(compile(source, '<serializer>', 'exec'), namespace)
+    return namespace['serialize']
+
+
+def compile_fields(fields):
+    """ Compile a flask_restful field dict into a function equivalent to marshal. """
+    serialize_one = _compile_one(fields)
+
+    def serialize(data):
+        if isinstance(data, (list, tuple)):
+            return [serialize_one(d) for d in data]
+        return serialize_one(data)
+    return serialize
+
+
+def serializer_for(fields):
+    """ Compiled serializer for `fields`, cached by the field objects it uses. """
+    key = tuple((k, id(v)) for k, v in fields.items())
+    entry = _serializers.get(key)
+    if entry is None:
+        # keep `fields` referenced so the ids in the key stay unique
+        entry = (fields, compile_fields(fields))
+        _serializers.set(key, entry)
+    return entry[1]
@@ -1,5 +1,27 @@
+import math
 from email_validator import validate_email
 
 
 def email(email_input):
     return validate_email(email_input)['email']
+
+
+def finite_float(value):
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError('{} is not a finite number'.format(value))
+    return number
+
+
+def positive_float(value):
+    number = finite_float(value)
+    if number <= 0:
+        raise ValueError('{} is not a positive number'.format(value))
+    return number
+
+
+def non_negative_float(value):
+    number = finite_float(value)
+    if number < 0:
+        raise ValueError('{} is a negative number'.format(value))
+    return number
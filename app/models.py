@@ -1,14 +1,18 @@
 import datetime
 import json
+import math
 
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import ForeignKey, Column
-from sqlalchemy import Integer, Float, String, Text, Boolean, DateTime
-from sqlalchemy.orm import relationship
+from sqlalchemy import ForeignKey, Column, Index, event, func, select
+from sqlalchemy import Integer, Float, String, Text, Boolean, DateTime, LargeBinary
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import relationship, Session
 
 from flask import current_app
-from passlib.context import CryptContext
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
+from app.common.cache import credential_cache, polygon_cache, response_cache
+from app.common.hashing import password_hasher
+from app.utils import geometry
 
 db = SQLAlchemy()
 
@@ -20,55 +24,75 @@ class User(db.Model):
     password_hash = Column(String(128), nullable=False)
     full_name = Column(String(128), default='')
     is_admin = Column(Boolean, default=False)
+    token_version = Column(Integer, default=0, nullable=False)
 
     projects = relationship('Project', back_populates='creator')
 
-    _static_pwd_context = None
-
-    @property
-    def _pwd_context(self):
-        if User._static_pwd_context is None:
-            config = current_app.config['PASSLIB_CONTEXT_CONFIG']
-            User._static_pwd_context = CryptContext.from_string(config)
-        return User._static_pwd_context
-
     @property
     def password(self):
         raise AttributeError('`password` is not a readable attribute')
 
     @password.setter
     def password(self, password):
-        self.password_hash = self._pwd_context.hash(password)
+        self.password_hash = password_hasher.hash(password)
+        # revoke tokens issued for the old password
+        self.token_version = (self.token_version or 0) + 1
+        if self.id is not None:
+            credential_cache.invalidate(self.id)
 
     def verify_password(self, password):
-        return self._pwd_context.verify(password, self.password_hash)
+        valid, new_hash = password_hasher.verify_and_update(password, self.password_hash)
+        if valid and new_hash:
+            # transparently upgrade hashes created under an older policy
+            self.password_hash = new_hash
+        return valid
 
     @property
     def token(self, expiration=3600):
         s = Serializer(current_app.config['SECRET_KEY'], expires_in=expiration)
-        return str(s.dumps({'id': self.id}), encoding='utf-8')
+        claims = {
+            'id': self.id,
+            'adm': bool(self.is_admin),
+            'ver': self.token_version
+        }
+        return str(s.dumps(claims), encoding='utf-8')
+
+    def matches_token(self, claims):
+        """ Tokens issued before a password or role change are rejected. """
+        return claims.get('ver', self.token_version) == self.token_version and \
+            claims.get('adm', bool(self.is_admin)) == bool(self.is_admin)
 
     @staticmethod
-    def verify_token(token):
+    def load_token(token):
         s = Serializer(current_app.config['SECRET_KEY'])
-        data = s.loads(token)
+        return s.loads(token)
+
+    @staticmethod
+    def verify_token(token):
+        data = User.load_token(token)
         user = User.query.get(data['id'])
+        if user and not user.matches_token(data):
+            return None
         return user
 
 
 class Project(db.Model):
     __talbename__ = 'project'
+    __table_args__ = (
+        Index('ix_project_remark', 'remark', mysql_length=191),
+    )
     id = Column(Integer, primary_key=True)
-    name = Column(String(128))
-    type = Column(String(128))
+    name = Column(String(128), index=True)
+    type = Column(String(128), index=True)
 
-    space_x = Column(Float, comment='in meters')
+    space_x = Column(Float, index=True, comment='in meters')
     space_y = Column(Float, comment='in meters')
     space_z = Column(Float, comment='in meters')
 
     creator_id = Column(Integer, ForeignKey('user.id'))
     creator = relationship('User', back_populates='projects')
-    updated_on = Column(DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now)
+    updated_on = Column(DateTime, index=True, default=datetime.datetime.now,
+                        onupdate=datetime.datetime.now)
 
     prototype_x = Column(Float, default=0, comment='in meters')
     prototype_y = Column(Float, default=0, comment='in meters')
@@ -93,9 +117,19 @@ class Project(db.Model):
     def allocated(self):
         return self.marker is not None
 
+    @staticmethod
+    def version():
+        """ Changes whenever a project is added, changed or removed. """
+        return tuple(db.session.query(func.max(Project.updated_on), func.count(Project.id)).one())
+
 
 class Marker(db.Model):
     __tablename__ = 'marker'
+    __table_args__ = (
+        Index('ix_marker_centre', 'map_id', 'centre_x', 'centre_y'),
+        Index('ix_marker_bbox', 'map_id', 'min_x', 'max_x', 'min_y', 'max_y'),
+        Index('ix_marker_seq', 'map_id', 'seq'),
+    )
     id = Column(Integer, primary_key=True)
 
     project_id = Column(Integer, ForeignKey('project.id'))
@@ -104,44 +138,72 @@ class Marker(db.Model):
     map_id = Column(Integer, ForeignKey('map.id'))
     map = relationship('Map', back_populates='markers')
 
-    polygon_json = Column(Text, default='[]')
+    # polygons are stored packed in polygon_blob, polygon_json is only
+    # read for rows `flask markers migrate` has not converted yet
+    polygon_json = Column(Text, nullable=True)
+    polygon_blob = Column(LargeBinary, nullable=True, comment='little-endian int32 x, y pairs')
+
+    # derived from the polygon by its setter, None for an empty polygon
+    centre_x = Column(Integer)
+    centre_y = Column(Integer)
+    min_x = Column(Integer)
+    min_y = Column(Integer)
+    max_x = Column(Integer)
+    max_y = Column(Integer)
+
+    # 'marker:seq' value of the last write, for ?since= delta sync
+    seq = Column(Integer, default=0, server_default='0', nullable=False)
 
-    def _clean_contour(self, contours):
-        clean_contours = [{
-            'x': int(point['x']),
-            'y': int(point['y'])
-        } for point in contours]
-        return clean_contours
+    @property
+    def coordinates(self):
+        """ Flat array of x, y coordinates. """
+        if self.polygon_blob is not None:
+            return geometry.unpack(self.polygon_blob)
+        return geometry.from_json(self.polygon_json)
 
     @property
     def polygon(self):
-        return self._clean_contour(json.loads(self.polygon_json))
+        return geometry.to_points(self.coordinates)
 
     @polygon.setter
     def polygon(self, contours):
-        self.polygon_json = json.dumps(self._clean_contour(contours))
+        self.polygon_blob = geometry.pack(contours)
+        self.polygon_json = None
+        self.update_geometry(geometry.unpack(self.polygon_blob))
+        if self.id is not None:
+            polygon_cache.invalidate(self.id)
+
+    def simplified_polygon(self, tolerance):
+        """ Polygon simplified to `tolerance` pixels, rounded down to a power of two. """
+        if tolerance < 1:
+            return self.polygon
+        bucket = 2 ** int(math.log2(tolerance))
+        source = self.polygon_blob if self.polygon_blob is not None else self.polygon_json
+        return polygon_cache.get(
+            self.id, source, bucket, lambda: geometry.simplify(self.coordinates, bucket))
+
+    def update_geometry(self, coords):
+        for column, value in geometry.derived_columns(coords).items():
+            setattr(self, column, value)
 
     @property
     def centre(self):
-        coords = self.polygon
-        if len(coords) >= 3:
-            cx, cy, area = 0.0, 0.0, 0.0
-            for i in range(len(coords)):
-                x_i = coords[i]['x']
-                y_i = coords[i]['y']
-                x_ip1 = coords[(i+1) % len(coords)]['x']
-                y_ip1 = coords[(i+1) % len(coords)]['y']
-                cx += (x_i + x_ip1) * (x_i * y_ip1 - x_ip1 * y_i)
-                cy += (y_i + y_ip1) * (x_i * y_ip1 - x_ip1 * y_i)
-                area += 0.5 * (x_i * y_ip1 - x_ip1 * y_i)
-            cx /= 6 * area
-            cy /= 6 * area
-            return {
-                'x': int(cx),
-                'y': int(cy)
-            }
-        else:
-            return coords[0]
+        if self.centre_x is not None:
+            return {'x': self.centre_x, 'y': self.centre_y}
+        # not backfilled yet
+        return geometry.centroid(self.coordinates)
+
+
+class MarkerTombstone(db.Model):
+    """ A marker deleted from, or moved off, a map at change sequence `seq`. """
+    __tablename__ = 'marker_tombstone'
+    __table_args__ = (
+        Index('ix_marker_tombstone_seq', 'map_id', 'seq'),
+    )
+    id = Column(Integer, primary_key=True)
+    marker_id = Column(Integer, nullable=False)
+    map_id = Column(Integer, nullable=False)
+    seq = Column(Integer, nullable=False)
 
 
 class Map(db.Model):
@@ -152,3 +214,178 @@ class Map(db.Model):
     level = Column(Integer)
     scale = Column(Float, comment="meter per pixel")
     markers = relationship('Marker', back_populates='map')
+
+
+class ImportJob(db.Model):
+    __tablename__ = 'import_job'
+    id = Column(Integer, primary_key=True)
+    status = Column(String(16), default='pending', comment='pending, running, finished or failed')
+    rows_processed = Column(Integer, default=0)
+    rows_failed = Column(Integer, default=0)
+    errors_json = Column(Text, default='[]')
+    message = Column(Text, default='')
+
+    creator_id = Column(Integer, ForeignKey('user.id'))
+    created_on = Column(DateTime, default=datetime.datetime.now)
+    updated_on = Column(DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now)
+
+    @property
+    def errors(self):
+        return json.loads(self.errors_json or '[]')
+
+    @errors.setter
+    def errors(self, errors):
+        self.errors_json = json.dumps(errors)
+
+
+class ProjectAggregate(db.Model):
+    """
+    Running totals over projects, kept up to date by app.utils.aggregates.
+    `scope` is 'total', 'type' (name is the project type) or 'map' (name is
+    the id of the map the projects are allocated on).
+    """
+    __tablename__ = 'project_aggregate'
+    scope = Column(String(16), primary_key=True)
+    name = Column(String(128), primary_key=True)
+    project_count = Column(Integer, default=0, nullable=False)
+    floor_area = Column(Float, default=0, nullable=False, comment='in square meters')
+    power_points_count = Column(Integer, default=0, nullable=False)
+    pedestal_big_count = Column(Integer, default=0, nullable=False)
+    pedestal_small_count = Column(Integer, default=0, nullable=False)
+    monitor_count = Column(Integer, default=0, nullable=False)
+    tv_count = Column(Integer, default=0, nullable=False)
+    table_count = Column(Integer, default=0, nullable=False)
+    chair_count = Column(Integer, default=0, nullable=False)
+
+
+class ChangeCounter(db.Model):
+    """
+    Counters bumped on every committed change to a table, used as cheap
+    validators. Names are 'map', 'marker', 'marker:<map_id>' and 'marker:*'
+    for bulk marker changes that could touch any map. 'marker:seq' numbers
+    marker writes and 'marker:resync' holds the sequence of the last bulk
+    marker change, which delta sync cannot replay.
+    """
+    __tablename__ = 'change_counter'
+    name = Column(String(64), primary_key=True)
+    value = Column(Integer, default=0, nullable=False)
+
+    @staticmethod
+    def _store(connection, name, value, initial):
+        """ Update the counter row to `value`, creating it with `initial` if missing. """
+        table = ChangeCounter.__table__
+        update = table.update().where(table.c.name == name).values(value=value)
+        if connection.execute(update).rowcount:
+            return
+        try:
+            # a savepoint, so losing the race does not abort the transaction
+            with connection.begin_nested():
+                connection.execute(table.insert().values(name=name, value=initial))
+        except IntegrityError:
+            # a concurrent transaction created the row first
+            connection.execute(update)
+
+    @staticmethod
+    def bump(connection, names):
+        table = ChangeCounter.__table__
+        for name in sorted(names):
+            ChangeCounter._store(connection, name, table.c.value + 1, 1)
+
+    @staticmethod
+    def next(connection, name):
+        """ Bump `name` and return its new value. """
+        ChangeCounter.bump(connection, {name})
+        table = ChangeCounter.__table__
+        return connection.execute(select([table.c.value]).where(table.c.name == name)).scalar()
+
+    @staticmethod
+    def set(connection, name, value):
+        ChangeCounter._store(connection, name, value, value)
+
+    @staticmethod
+    def current(*names):
+        values = dict(db.session.query(ChangeCounter.name, ChangeCounter.value)
+                      .filter(ChangeCounter.name.in_(names)))
+        return tuple(values.get(name, 0) for name in names)
+
+
+def marker_map_ids(marker):
+    """ Maps a flushed marker belongs or belonged to. """
+    history = db.inspect(marker).attrs.map_id.history
+    return {i for i in (marker.map_id, *(history.deleted or ())) if i is not None}
+
+
+@event.listens_for(Session, 'before_flush')
+def sequence_marker_changes(session, flush_context, instances):
+    """
+    Stamp written markers with the next 'marker:seq' value and leave
+    tombstones on the maps markers were deleted from or moved off. The
+    counter row stays locked until commit, so sequences commit in order.
+    Markers embed their project, so the marker of a changed or deleted
+    project is stamped as well; on delete its project_id is only nulled
+    later in the flush.
+    """
+    written = [obj for obj in (*session.new, *session.dirty)
+               if isinstance(obj, Marker) and session.is_modified(obj)]
+    deleted = [obj for obj in session.deleted if isinstance(obj, Marker)]
+    projects = [obj for obj in (*session.dirty, *session.deleted) if isinstance(obj, Project)
+                and (obj in session.deleted or session.is_modified(obj))]
+    written += [project.marker for project in projects
+                if project.marker is not None and project.marker not in written
+                and project.marker not in session.deleted]
+    if not written and not deleted:
+        return
+    seq = ChangeCounter.next(session.connection(), 'marker:seq')
+    for marker in written:
+        marker.seq = seq
+        for map_id in marker_map_ids(marker) - {marker.map_id}:
+            session.add(MarkerTombstone(marker_id=marker.id, map_id=map_id, seq=seq))
+    for marker in deleted:
+        for map_id in marker_map_ids(marker):
+            session.add(MarkerTombstone(marker_id=marker.id, map_id=map_id, seq=seq))
+
+
+@event.listens_for(Session, 'after_flush')
+def bump_change_counters(session, flush_context):
+    names = set()
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, Map):
+            names.add('map')
+        elif isinstance(obj, Marker):
+            names.add('marker')
+            names.update(f'marker:{i}' for i in marker_map_ids(obj))
+    if names:
+        ChangeCounter.bump(session.connection(), names)
+        session.info.setdefault('changed_counters', set()).update(names)
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def bump_bulk_change_counters(context):
+    model = context.mapper.class_
+    session = context.session
+    if model is Map:
+        names = {'map'}
+        ChangeCounter.bump(session.connection(), names)
+    elif model is Marker:
+        names = {'marker', 'marker:*'}
+        connection = session.connection()
+        ChangeCounter.bump(connection, names)
+        resync = ChangeCounter.next(connection, 'marker:seq')
+        ChangeCounter.set(connection, 'marker:resync', resync)
+        # clients older than the resync point start over, their tombstones are unused
+        tombstones = MarkerTombstone.__table__
+        connection.execute(tombstones.delete().where(tombstones.c.seq <= resync))
+    else:
+        return
+    session.info.setdefault('changed_counters', set()).update(names)
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_responses(session):
+    response_cache.invalidate(session.info.pop('changed_counters', ()))
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_changed_counters(session):
+    session.info.pop('changed_counters', None)
@@ -1,7 +1,9 @@
 from flask import Blueprint, jsonify, render_template, current_app
 from flask_restful import fields, marshal_with, reqparse
 from app.common.auth import auth
+from app.common.cache import credential_cache, polygon_cache, response_cache
 from app.models import db, Marker, User
+from app.utils.aggregates import clear_scope
 from app.utils.allocation import allocate
 from app.utils.email import send_emails
 from app.resources.project import project_fields
@@ -52,5 +54,16 @@ def send_notifications():
 @auth.admin_required
 def reset_allocation():
     Marker.query.delete()
+    clear_scope(db.session.connection(), 'map')
     db.session.commit()
     return jsonify({'message': 'Completetd successfully'})
+
+
+@admin_bp.route('/cache_stats', methods=['GET'])
+@auth.admin_required
+def cache_stats():
+    return jsonify({
+        'credentials': credential_cache.stats(),
+        'polygons': polygon_cache.stats(),
+        'responses': response_cache.stats()
+    })
@@ -1,8 +1,11 @@
 from flask import Blueprint, render_template, current_app
-from flask_restful import Api, fields, marshal_with, Resource
+from flask_restful import Api, fields, Resource
 from app.common.auth import auth
+from app.common.cache import response_cache
+from app.common.etag import list_etag, not_modified, etag_headers
 from app.common.exceptions import NotFoundException
-from app.models import Map
+from app.common.serializer import compile_fields
+from app.models import Map, ChangeCounter
 
 map_bp = Blueprint('map', __name__)
 api = Api(map_bp)
@@ -15,22 +18,30 @@ map_field = {
     'scale': fields.Float
 }
 
+serialize_maps = compile_fields(map_field)
+
 
 class MapListView(Resource):
     @auth.login_required
-    @marshal_with(map_field)
     def get(self):
-        return Map.query.all()
+        version = ChangeCounter.current('map')
+        etag = list_etag(version)
+        return not_modified(etag) or (response_cache.get(
+            'map', 'list', version, lambda: serialize_maps(Map.query.all())), 200, etag_headers(etag))
 
 
 class MapView(Resource):
-    @auth.login_required
-    @marshal_with(map_field)
-    def get(self, map_id):
+    @staticmethod
+    def get_map(map_id):
         m = Map.query.filter(Map.id == map_id).first()
         if not m:
             raise NotFoundException(Map)
-        return m
+        return serialize_maps(m)
+
+    @auth.login_required
+    def get(self, map_id):
+        return response_cache.get(
+            'map', map_id, ChangeCounter.current('map'), lambda: self.get_map(map_id))
 
 
 @map_bp.route('/maps/page')
@@ -1,9 +1,19 @@
 import json
-from flask import Blueprint, jsonify
+import time
+from collections import OrderedDict
+from flask import Blueprint, current_app, jsonify
 from flask_restful import Api, fields, marshal_with, Resource, reqparse
+from sqlalchemy.orm import joinedload
 from app.common.auth import auth
-from app.common.exceptions import NotFoundException
-from app.models import db, Map, Marker
+from app.common.cache import response_cache
+from app.common.etag import list_etag, not_modified, etag_headers
+from app.common.exceptions import NotFoundException, InvalidUsage
+from app.common.fieldsets import parse_fieldset, load_fieldset, eager_fieldset
+from app.common.serializer import serializer_for
+from app.common.validator import finite_float, positive_float, non_negative_float
+from app.models import db, Map, Marker, MarkerTombstone, Project, ChangeCounter
+from app.utils import geometry
+from app.utils.spatial import marker_indexes
 
 marker_bp = Blueprint('marker', __name__)
 api = Api(marker_bp)
@@ -26,6 +36,18 @@ marker_field = {
     'map_id': fields.Integer
 }
 
+# columns behind the computed marker fields
+marker_field_columns = {
+    'centre': ['centre_x', 'centre_y'],
+    'polygon': ['polygon_blob', 'polygon_json'],
+    'project': ['project_id']
+}
+
+# relationships behind nested fields, joined into the list query
+marker_field_loaders = {
+    'project': joinedload(Marker.project).load_only('id', 'name')
+}
+
 
 def polygon(polygon_json):
     """ Return coordinates list if valid, raise an exception in other case. """
@@ -35,19 +57,113 @@ def polygon(polygon_json):
             'x': int(point['x']),
             'y': int(point['y'])
         } for point in polygon]
-        return clean_polygon
     except Exception:
         raise ValueError('{} is not a valid polygon'.format(polygon_json))
+    # polygons are stored as int32 pairs
+    if any(not geometry.COORDINATE_MIN <= v <= geometry.COORDINATE_MAX
+           for point in clean_polygon for v in point.values()):
+        raise ValueError('{} has coordinates out of range'.format(polygon_json))
+    return clean_polygon
+
+
+def bbox(value):
+    """ Parse `minx,miny,maxx,maxy` in map pixels. """
+    try:
+        min_x, min_y, max_x, max_y = (int(float(v)) for v in value.split(','))
+    except Exception:
+        raise ValueError('{} is not a valid bbox, expected minx,miny,maxx,maxy'.format(value))
+    if min_x > max_x or min_y > max_y:
+        raise ValueError('bbox minimum must not exceed its maximum')
+    return min_x, min_y, max_x, max_y
 
 
 class MarkerListView(Resource):
-    @auth.login_required
-    @marshal_with(marker_field)
-    def get(self, map_id):
+    @staticmethod
+    def query(map_id, fieldset, viewport=None):
         m = Map.query.filter(Map.id == map_id).first()
         if not m:
             raise NotFoundException(Map)
-        return m.markers
+        markers = Marker.query.filter(Marker.map_id == map_id).options(
+            load_fieldset(Marker, fieldset, marker_field_columns),
+            *eager_fieldset(fieldset, marker_field_loaders))
+        if viewport:
+            # bounding boxes overlapping the viewport, served by ix_marker_bbox
+            min_x, min_y, max_x, max_y = viewport
+            markers = markers.filter(
+                Marker.min_x <= max_x, Marker.max_x >= min_x,
+                Marker.min_y <= max_y, Marker.max_y >= min_y)
+        return markers
+
+    @staticmethod
+    def serialize(markers, fieldset, tolerance):
+        if not tolerance or 'polygon' not in fieldset:
+            return serializer_for(fieldset)(markers)
+        # simplified polygons replace the full ones after serialization
+        data = serializer_for(OrderedDict(
+            (k, v) for k, v in fieldset.items() if k != 'polygon'))(markers)
+        for item, marker in zip(data, markers):
+            item['polygon'] = marker.simplified_polygon(tolerance)
+        return data
+
+    def changes(self, markers, map_id, since, wait):
+        """
+        Markers written and removed on the map after change sequence `since`,
+        waiting up to `wait` seconds for one. `reset` asks the client to
+        replace its copy when the changes cannot be replayed.
+        """
+        config = current_app.config
+        deadline = time.monotonic() + min(wait or 0, config['MARKER_FEED_MAX_WAIT'])
+        while True:
+            seq, resync = ChangeCounter.current('marker:seq', 'marker:resync')
+            # bulk changes leave no trace per marker, a client ahead of the
+            # database has seen a sequence that no longer exists
+            reset = since <= resync or since > seq
+            if reset:
+                return {'seq': seq, 'reset': True, 'upserts': markers.all(), 'deletes': []}
+            upserts = markers.filter(Marker.seq > since).all()
+            # a marker moved back or an id reused shows up as an upsert only
+            written = {m.id for m in upserts}
+            deletes = sorted({marker_id for marker_id, in db.session.query(MarkerTombstone.marker_id)
+                              .filter(MarkerTombstone.map_id == map_id, MarkerTombstone.seq > since)}
+                             - written)
+            if upserts or deletes or time.monotonic() >= deadline:
+                return {'seq': seq, 'reset': False, 'upserts': upserts, 'deletes': deletes}
+            # long poll until the next marker write on any map
+            while ChangeCounter.current('marker:seq')[0] == seq and time.monotonic() < deadline:
+                time.sleep(config['MARKER_FEED_POLL_INTERVAL'])
+                # end the read transaction so the next poll sees new commits
+                db.session.rollback()
+
+    @auth.login_required
+    def get(self, map_id):
+        fieldset = parse_fieldset(marker_field)
+        parser = reqparse.RequestParser()
+        parser.add_argument('bbox', type=bbox, location='args')
+        parser.add_argument('tolerance', type=positive_float, location='args')
+        parser.add_argument('since', type=int, location='args')
+        parser.add_argument('wait', type=non_negative_float, location='args')
+        args = parser.parse_args()
+        viewport, tolerance, since = args['bbox'], args['tolerance'], args['since']
+        if since is not None and viewport:
+            raise InvalidUsage('bbox cannot be combined with since')
+
+        if since is None:
+            # markers embed project names, so project changes count as well
+            version = (ChangeCounter.current(f'marker:{map_id}', 'marker:*'), Project.version())
+            etag = list_etag(*version)
+            response = not_modified(etag)
+            if response:
+                return response
+            # the payload does not depend on the user, unlike the ETag
+            key = (map_id, tuple(fieldset), viewport, tolerance)
+            data = response_cache.get(f'marker:{map_id}', key, version, lambda: self.serialize(
+                self.query(map_id, fieldset, viewport).all(), fieldset, tolerance))
+            return data, 200, etag_headers(etag)
+
+        markers = self.query(map_id, fieldset)
+        changes = self.changes(markers, map_id, since, args['wait'])
+        changes['upserts'] = self.serialize(changes['upserts'], fieldset, tolerance)
+        return changes
 
     @auth.admin_required
     @marshal_with(marker_field)
@@ -65,6 +181,7 @@ class MarkerListView(Resource):
 
         db.session.add(marker)
         db.session.commit()
+        marker_indexes.added(marker)
 
         return marker
 
@@ -94,6 +211,7 @@ class MarkerView(Resource):
         args = parser.parse_args()
 
         marker = self.get_marker(map_id, marker_id)
+        old_map_id = marker.map_id
         for k, v in args.items():
             if v is not None:
                 setattr(marker, k, v)
@@ -102,14 +220,130 @@ class MarkerView(Resource):
             marker.project_id = None
 
         db.session.commit()
+        marker_indexes.changed(marker, old_map_id)
         return marker
 
     @auth.admin_required
     def delete(self, map_id, marker_id):
         db.session.delete(self.get_marker(map_id, marker_id))
         db.session.commit()
+        marker_indexes.removed(map_id, marker_id)
         return jsonify({'message': f'Marker {marker_id} deleted'})
 
 
+class MarkerBatchView(Resource):
+    operations = ('create', 'update', 'delete')
+
+    @classmethod
+    def parse_operation(cls, operation):
+        """ Validate one batch operation, raise ValueError if it is not valid. """
+        if not isinstance(operation, dict) or operation.get('op') not in cls.operations:
+            raise ValueError("op must be one of {}".format(', '.join(cls.operations)))
+        args = {'op': operation['op']}
+        if args['op'] == 'create':
+            if operation.get('polygon_json') is None:
+                raise ValueError('polygon_json is required')
+        elif operation.get('id') is None:
+            raise ValueError('id is required')
+        else:
+            args['id'] = int(operation['id'])
+        if args['op'] != 'delete':
+            if operation.get('polygon_json') is not None:
+                args['polygon'] = polygon(operation['polygon_json'])
+            for key in ('map_id', 'project_id'):
+                if operation.get(key) is not None:
+                    args[key] = int(operation[key])
+        return args
+
+    @auth.admin_required
+    def post(self, map_id):
+        parser = reqparse.RequestParser()
+        parser.add_argument('operations', type=list, location='json', required=True)
+        operations = parser.parse_args()['operations']
+
+        # validate the whole batch before touching the database
+        batch, errors = [], {}
+        for i, operation in enumerate(operations):
+            try:
+                batch.append(self.parse_operation(operation))
+            except (ValueError, TypeError) as e:
+                errors[str(i)] = str(e)
+        if errors:
+            raise InvalidUsage(errors)
+
+        if not Map.query.get(map_id):
+            raise NotFoundException(Map)
+        marker_ids = {args['id'] for args in batch if 'id' in args}
+        markers = {m.id: m for m in Marker.query.filter(
+            Marker.map_id == map_id, Marker.id.in_(marker_ids))} if marker_ids else {}
+        missing = sorted(marker_ids - markers.keys())
+        if missing:
+            raise NotFoundException(f'Marker {missing[0]} not found')
+
+        created, updated, deleted = [], {}, []
+        old_map_ids = {}
+        for args in batch:
+            op = args.pop('op')
+            if op == 'delete':
+                marker_id = args['id']
+                if marker_id not in deleted:
+                    db.session.delete(markers[marker_id])
+                    updated.pop(marker_id, None)
+                    deleted.append(marker_id)
+                continue
+            if op == 'create':
+                marker = Marker(map_id=map_id)
+                db.session.add(marker)
+                created.append(marker)
+            else:
+                marker = markers[args.pop('id')]
+                if marker.id in deleted:
+                    continue
+                old_map_ids.setdefault(marker.id, marker.map_id)
+                updated[marker.id] = marker
+            for k, v in args.items():
+                setattr(marker, k, v)
+            if args.get('project_id') == 0:
+                marker.project_id = None
+
+        # a single flush and commit for the whole batch
+        db.session.flush()
+        written = created + list(updated.values())
+        upserts = [(m.id, m.map_id, old_map_ids.get(m.id), m.coordinates) for m in written]
+        db.session.commit()
+        marker_indexes.applied(upserts, [(map_id, marker_id) for marker_id in deleted])
+
+        if upserts:
+            # refresh the written markers and their projects in one query
+            Marker.query.filter(Marker.id.in_([marker_id for marker_id, *_ in upserts])) \
+                .options(joinedload(Marker.project).load_only('id', 'name')).all()
+        serialize = serializer_for(marker_field)
+        return {
+            'created': serialize(created),
+            'updated': serialize(list(updated.values())),
+            'deleted': deleted
+        }
+
+
+class MarkerHitView(Resource):
+    @auth.login_required
+    def get(self, map_id):
+        parser = reqparse.RequestParser()
+        parser.add_argument('x', type=finite_float, required=True, location='args')
+        parser.add_argument('y', type=finite_float, required=True, location='args')
+        args = parser.parse_args()
+
+        if not Map.query.get(map_id):
+            raise NotFoundException(Map)
+        marker_ids = marker_indexes.get(map_id).query(args['x'], args['y'])
+        if not marker_ids:
+            return []
+        markers = Marker.query.filter(Marker.id.in_(marker_ids)).order_by(Marker.id) \
+            .options(joinedload(Marker.project).load_only('id', 'name'))
+        return serializer_for(marker_field)(markers.all())
+
+
 api.add_resource(MarkerListView, '/maps/<int:map_id>/markers')
+api.add_resource(MarkerHitView, '/maps/<int:map_id>/markers/at')
+api.add_resource(MarkerBatchView, '/maps/<int:map_id>/markers/batch')
 api.add_resource(MarkerView, '/maps/<int:map_id>/markers/<int:marker_id>')
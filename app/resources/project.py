@@ -1,14 +1,19 @@
-import os
-import csv
-import re
-import string
-import logging
-from flask import Blueprint, jsonify, request, current_app
-from flask_restful import Api, fields, marshal_with, Resource, reqparse
+import shutil
+import tempfile
+from flask import Blueprint, Response, jsonify, request, current_app, stream_with_context
+from flask_restful import Api, fields, inputs, marshal, marshal_with, Resource, reqparse
+from sqlalchemy.orm import selectinload
 from app.common.auth import auth, ForbiddenException
+from app.common.etag import list_etag, not_modified, etag_headers
 from app.common.exceptions import NotFoundException, InvalidUsage
-from app.models import db, Project
-from werkzeug.utils import secure_filename
+from app.common.fieldsets import parse_fieldset, load_fieldset, eager_fieldset
+from app.common.filters import FilterSet
+from app.common.pagination import paginate
+from app.common.serializer import serializer_for
+from app.models import db, Project, Marker, Map, ImportJob, ChangeCounter, ProjectAggregate
+from app.utils.aggregates import tracking
+from app.utils.csv_import import import_projects, parse_project_row, submit_import_job
+from app.utils.export import export_rows, to_csv, to_ndjson
 
 project_bp = Blueprint('project', __name__)
 api = Api(project_bp)
@@ -41,159 +46,157 @@ project_fields = {
     'remark': fields.String
 }
 
+import_error_fields = {
+    'first_line': fields.Integer,
+    'last_line': fields.Integer,
+    'message': fields.String
+}
+
+import_result_fields = {
+    'imported': fields.Integer,
+    'failed': fields.Integer,
+    'errors': fields.List(fields.Nested(import_error_fields))
+}
 
-def ascii_str(text, length_limit=-1):
-    text = str(text)
-    text = ''.join(filter(lambda c: c in set(string.printable), text))
-    if length_limit > 0:
-        text = text[:length_limit]
-    return text
+import_job_fields = {
+    'job_id': fields.Integer(attribute='id'),
+    'status': fields.String,
+    'rows_processed': fields.Integer,
+    'rows_failed': fields.Integer,
+    'errors': fields.List(fields.Nested(import_error_fields)),
+    'message': fields.String,
+    'created_on': fields.DateTime,
+    'updated_on': fields.DateTime
+}
+
+# relationships behind computed fields, loaded for the whole list at once
+project_field_loaders = {
+    'allocated': selectinload(Project.marker).load_only('id', 'project_id')
+}
+
+aggregate_fields = {
+    'project_count': fields.Integer,
+    'floor_area': fields.Float(default=0),
+    'power_points_count': fields.Integer,
+    'pedestal_big_count': fields.Integer,
+    'pedestal_small_count': fields.Integer,
+    'monitor_count': fields.Integer,
+    'tv_count': fields.Integer,
+    'table_count': fields.Integer,
+    'chair_count': fields.Integer
+}
+
+project_filters = FilterSet(
+    Project,
+    numeric=(
+        'id', 'space_x', 'space_y', 'space_z', 'creator_id', 'updated_on',
+        'prototype_x', 'prototype_y', 'prototype_z', 'prototype_weight',
+        'power_points_count', 'pedestal_big_count', 'pedestal_small_count',
+        'monitor_count', 'tv_count', 'table_count', 'chair_count',
+        'hdmi_to_vga_adapter_count', 'hdmi_cable_count'
+    ),
+    text=('name', 'type', 'pedestal_description', 'remark')
+)
+
+
+def update_parser():
+    """ Parser for the optional fields a project update may change. """
+    parser = reqparse.RequestParser()
+    parser.add_argument('name', type=str)
+    parser.add_argument('type', type=str)
+    parser.add_argument('space_x', type=float)
+    parser.add_argument('space_y', type=float)
+    parser.add_argument('space_z', type=float)
+    parser.add_argument('prototype_x', type=float)
+    parser.add_argument('prototype_y', type=float)
+    parser.add_argument('prototype_z', type=float)
+    parser.add_argument('prototype_weight', type=float)
+    parser.add_argument('power_points_count', type=int)
+    parser.add_argument('pedestal_big_count', type=int)
+    parser.add_argument('pedestal_small_count', type=int)
+    parser.add_argument('pedestal_description', type=str)
+    parser.add_argument('monitor_count', type=int)
+    parser.add_argument('tv_count', type=int)
+    parser.add_argument('table_count', type=int)
+    parser.add_argument('chair_count', type=int)
+    parser.add_argument('hdmi_to_vga_adapter_count', type=int)
+    parser.add_argument('hdmi_cable_count', type=int)
+    parser.add_argument('remark', type=str)
+    return parser
 
 
 class ProjectListView(Resource):
     @auth.login_required
-    @marshal_with(project_fields)
     def get(self):
+        fieldset = parse_fieldset(project_fields)
+        # `allocated` depends on the markers
+        etag = list_etag(Project.version(), ChangeCounter.current('marker'))
+        response = not_modified(etag)
+        if response:
+            return response
+
+        headers = etag_headers(etag)
         if auth.current_user.is_admin:
-            # create RequestParser to parse keyword
-            keywordParser = reqparse.RequestParser()
-            keywordParser.add_argument('id')
-            keywordParser.add_argument('name')
-            keywordParser.add_argument('type')
-            keywordParser.add_argument('space_x')
-            keywordParser.add_argument('space_y')
-            keywordParser.add_argument('space_z')
-            keywordParser.add_argument('creator_id')
-            keywordParser.add_argument('updated_on')
-            keywordParser.add_argument('prototype_x')
-            keywordParser.add_argument('prototype_y')
-            keywordParser.add_argument('prototype_z')
-            keywordParser.add_argument('prototype_weight')
-            keywordParser.add_argument('power_points_count')
-            keywordParser.add_argument('pedestal_big_count')
-            keywordParser.add_argument('pedestal_small_count')
-            keywordParser.add_argument('pedestal_description')
-            keywordParser.add_argument('monitor_count')
-            keywordParser.add_argument('tv_count')
-            keywordParser.add_argument('table_count')
-            keywordParser.add_argument('chair_count')
-            keywordParser.add_argument('hdmi_to_vga_adapter_count')
-            keywordParser.add_argument('hdmi_cable_count')
-            keywordParser.add_argument('remark')
-
-            args = keywordParser.parse_args()
-            '''#if keyword is present
-            if args['name']:
-                #use sqlalchemy to do the search, return filtered result
-                search = "%{}%".format(args['name'])
-                return Project.query.filter(Project.name.like(search)).all()
-            #if no keyword, return all'''
-            isEmpty = True
-            q = db.session.query(Project)
-            for attr, value in args.items():
-                if args[attr]:
-                    isEmpty = False
-                    q = q.filter(getattr(Project, attr).like("%%%s%%" % value))
-            if isEmpty:
-                return Project.query.all()
-            else:
-                return q.all()
+            args = project_filters.parse_args()
+
+            pageParser = reqparse.RequestParser()
+            pageParser.add_argument('limit', type=inputs.positive)
+            pageParser.add_argument('cursor', type=str)
+            pageParser.add_argument('sort', choices=('id', 'updated_on'), default='id')
+            pageParser.add_argument('count', type=inputs.boolean, default=False)
+            page = pageParser.parse_args()
+
+            q = project_filters.apply(db.session.query(Project), args)
+            q = q.options(load_fieldset(Project, fieldset),
+                          *eager_fieldset(fieldset, project_field_loaders))
+
+            if not page['limit'] and not page['cursor']:
+                return serializer_for(fieldset)(q.all()), 200, headers
+
+            limit = min(page['limit'] or current_app.config['MAX_PAGE_SIZE'],
+                        current_app.config['MAX_PAGE_SIZE'])
+            projects, next_cursor, total = paginate(
+                q, Project, limit, page['cursor'], page['sort'], page['count'])
+            if next_cursor:
+                headers['X-Next-Cursor'] = next_cursor
+            if total is not None:
+                headers['X-Total-Count'] = str(total)
+            return serializer_for(fieldset)(projects), 200, headers
         else:
-            return auth.current_user.projects
+            return serializer_for(fieldset)(auth.current_user.projects), 200, headers
 
     def allowed_file(self, filename, allowed_extensions):
         return '.' in filename and \
             filename.rsplit('.', 1)[1] in allowed_extensions
 
     def parse_csv_line(self, line):
-        if len(line) < 4:
-            raise InvalidUsage(
-                'At least 4 columns (name, type, type description, space requirement)'
-                + 'are required for CSV file')
-        result = {}
-        result['name'] = ascii_str(line[0], 127)
-        result['type'] = ascii_str(line[1] + ' ' + line[2], 127)
-        space_numbers = [float(s) for s in re.findall(r"\d+\.?\d*", line[3])]
-        use_cm = 'cm' in line[3]
-        if use_cm:
-            space_numbers = [n / 100 for n in space_numbers]
-        result['space_x'] = space_numbers[0] if len(space_numbers) > 0 else 2.0
-        result['space_y'] = space_numbers[1] if len(space_numbers) > 1 else 2.0
-        result['space_z'] = space_numbers[2] if len(space_numbers) > 2 else 2.0
-
-        # parse other optional parameters
-        if len(line) > 4:
-            prototype_nums = [float(s) for s in re.findall(r"\d+\.?\d*", line[4])]
-            use_cm = 'cm' in line[4]
-            result['prototype_weight'] = prototype_nums[3] if len(prototype_nums) > 3 else 0
-            if use_cm:
-                prototype_nums = [n / 100 for n in prototype_nums]
-            result['prototype_x'] = prototype_nums[0] if len(prototype_nums) > 0 else 0
-            result['prototype_y'] = prototype_nums[1] if len(prototype_nums) > 1 else 0
-            result['prototype_z'] = prototype_nums[2] if len(prototype_nums) > 2 else 0
-
-            mapping = {
-                5: (int, 'power_points_count'),
-                6: (int, 'pedestal_big_count'),
-                7: (int, 'pedestal_small_count'),
-                8: (ascii_str, 'pedestal_description'),
-                9: (int, 'monitor_count'),
-                10: (int, 'tv_count'),
-                11: (int, 'table_count'),
-                12: (int, 'chair_count'),
-                13: (int, 'hdmi_to_vga_adapter_count'),
-                14: (int, 'hdmi_cable_count'),
-                16: (ascii_str, 'remark')
-            }
-            for i in range(5, len(line)):
-                if i in mapping:
-                    dtype = mapping[i][0]
-                    dkey = mapping[i][1]
-                    try:
-                        dvalue = dtype(line[i])
-                        result[dkey] = dvalue
-                    except Exception:
-                        pass
-        return result
+        return parse_project_row(line)
 
     @auth.login_required
-    @marshal_with(project_fields)
     def post(self):
         # for CSV uploading
         file = request.files.get('file')
         if file and self.allowed_file(file.filename, 'csv'):
             auth.admin_required(lambda: None)()
 
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-
-            new_projects = []
-            with open(filepath, 'r') as csv_file:
-                try:
-                    reader = csv.reader(csv_file)
-                    # skip headers
-                    try:
-                        next(reader)
-                    except StopIteration:
-                        raise InvalidUsage('One header line is expected')
-                    # go through every data line
-                    for line in reader:
-                        data_dict = self.parse_csv_line(line)
-                        data_dict['creator'] = auth.current_user
-                        new_project = Project(**data_dict)
-                        new_projects.append(new_project)
-                        db.session.add(new_project)
-                except csv.Error as e:
-                    logging.info(e)
-                    raise InvalidUsage('Invalid CSV foramt')
-                except UnicodeDecodeError as e:
-                    logging.info(e)
-                    raise InvalidUsage('Invalid character in CSV file')
-
-            db.session.commit()
-
-            return new_projects
+            parser = reqparse.RequestParser()
+            parser.add_argument('async', type=inputs.boolean, default=False, location='values')
+            if parser.parse_args()['async']:
+                # the request stream is gone once we return, keep a copy for the job
+                upload = tempfile.TemporaryFile()
+                shutil.copyfileobj(file.stream, upload)
+                upload.seek(0)
+                job = submit_import_job(
+                    current_app._get_current_object(), upload, auth.current_user.id)
+                return marshal(job, import_job_fields), 202, \
+                    {'Location': api.url_for(ImportJobView, job_id=job.id)}
+
+            result = import_projects(
+                file.stream,
+                auth.current_user.id,
+                self.parse_csv_line,
+                current_app.config['CSV_IMPORT_CHUNK_SIZE'])
+            return marshal(result, import_result_fields)
 
         # for normal uploading
         parser = reqparse.RequestParser()
@@ -224,73 +227,75 @@ class ProjectListView(Resource):
             raise InvalidUsage('Only one submission allowed')
 
         project_attributes = dict(args)
-        project_attributes['creator'] = auth.current_user
+        project_attributes['creator'] = auth.load_current_user()
         project = Project(**project_attributes)
 
         db.session.add(project)
         db.session.commit()
 
-        return project
+        return marshal(project, project_fields)
+
+    def find_missing(self, ids):
+        found = {i for i, in db.session.query(Project.id).filter(Project.id.in_(ids))}
+        missing = [i for i in ids if i not in found]
+        if missing:
+            raise NotFoundException(f'Project {missing[0]} not found')
 
     @auth.admin_required
     def delete(self):
         parser = reqparse.RequestParser()
         parser.add_argument('ids', type=int, action='append', location='json', required=True)
         args = parser.parse_args()
+        ids = set(args['ids'])
+
+        self.find_missing(ids)
+        with tracking(ids):
+            # detach markers the same way the ORM delete did, then delete in one statement
+            Marker.query.filter(Marker.project_id.in_(ids)) \
+                .update({Marker.project_id: None}, synchronize_session=False)
+            Project.query.filter(Project.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
 
-        to_be_deleted = []
-        for project_id in args['ids']:
-            project = Project.query.filter(Project.id == project_id).first()
-            if not project:
-                raise NotFoundException(f'Project {project_id} not found')
-            to_be_deleted.append(project)
-
-        for project in to_be_deleted:
-            db.session.delete(project)
+        return jsonify({'message': 'Project {} deleted'.format(str(args['ids']))})
 
+    @auth.admin_required
+    def patch(self):
+        parser = update_parser()
+        parser.add_argument('ids', type=int, action='append', location='json', required=True)
+        args = parser.parse_args()
+        ids = set(args.pop('ids'))
+        changes = {k: v for k, v in args.items() if v is not None}
+        if not changes:
+            raise InvalidUsage('No fields to update')
+
+        self.find_missing(ids)
+        with tracking(ids):
+            updated = Project.query.filter(Project.id.in_(ids)) \
+                .update(changes, synchronize_session=False)
         db.session.commit()
 
-        return jsonify({'message': 'Project {} deleted'.format(str(args['ids']))})
+        return jsonify({'message': f'{updated} projects updated', 'updated': updated})
 
 
 class ProjectView(Resource):
     @auth.login_required
-    def get_project(self, project_id):
-        project = Project.query.filter(Project.id == project_id).first()
+    def get_project(self, project_id, *options):
+        project = Project.query.options(*options).filter(Project.id == project_id).first()
         if not project:
             raise NotFoundException(Project)
-        if not auth.current_user.is_admin and project.creator != auth.current_user:
+        if not auth.current_user.is_admin and project.creator_id != auth.current_user.id:
             raise ForbiddenException()
         return project
 
-    @marshal_with(project_fields)
     def get(self, project_id):
-        return self.get_project(project_id)
+        fieldset = parse_fieldset(project_fields)
+        project = self.get_project(project_id, load_fieldset(
+            Project, fieldset, extra=['creator_id']))
+        return marshal(project, fieldset)
 
     @marshal_with(project_fields)
     def put(self, project_id):
-        parser = reqparse.RequestParser()
-        parser.add_argument('name', type=str)
-        parser.add_argument('type', type=str)
-        parser.add_argument('space_x', type=float)
-        parser.add_argument('space_y', type=float)
-        parser.add_argument('space_z', type=float)
-        parser.add_argument('prototype_x', type=float)
-        parser.add_argument('prototype_y', type=float)
-        parser.add_argument('prototype_z', type=float)
-        parser.add_argument('prototype_weight', type=float)
-        parser.add_argument('power_points_count', type=int)
-        parser.add_argument('pedestal_big_count', type=int)
-        parser.add_argument('pedestal_small_count', type=int)
-        parser.add_argument('pedestal_description', type=str)
-        parser.add_argument('monitor_count', type=int)
-        parser.add_argument('tv_count', type=int)
-        parser.add_argument('table_count', type=int)
-        parser.add_argument('chair_count', type=int)
-        parser.add_argument('hdmi_to_vga_adapter_count', type=int)
-        parser.add_argument('hdmi_cable_count', type=int)
-        parser.add_argument('remark', type=str)
-        args = parser.parse_args()
+        args = update_parser().parse_args()
 
         project = self.get_project(project_id)
         for k, v in args.items():
@@ -307,5 +312,55 @@ class ProjectView(Resource):
         return jsonify({'message': f'Project {project_id} deleted'})
 
 
+class ProjectExportView(Resource):
+    formats = {
+        'csv': (to_csv, 'text/csv'),
+        'ndjson': (to_ndjson, 'application/x-ndjson')
+    }
+
+    @auth.admin_required
+    def get(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument('format', choices=tuple(self.formats), default='csv', location='args')
+        export_format = parser.parse_args()['format']
+
+        encode, mimetype = self.formats[export_format]
+        return Response(
+            stream_with_context(encode(export_rows())),
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename=projects.{export_format}'})
+
+
+class ProjectAggregateView(Resource):
+    @auth.admin_required
+    def get(self):
+        result = {'total': marshal({}, aggregate_fields), 'types': [], 'maps': []}
+        map_names = dict(db.session.query(Map.id, Map.name))
+        rows = ProjectAggregate.query.order_by(ProjectAggregate.scope, ProjectAggregate.name)
+        for row in rows:
+            aggregate = marshal(row, aggregate_fields)
+            if row.scope == 'total':
+                result['total'] = aggregate
+            elif row.scope == 'type':
+                result['types'].append(dict(aggregate, type=row.name))
+            elif row.scope == 'map':
+                map_id = int(row.name)
+                result['maps'].append(dict(aggregate, map_id=map_id, map_name=map_names.get(map_id)))
+        return result
+
+
+class ImportJobView(Resource):
+    @auth.admin_required
+    @marshal_with(import_job_fields)
+    def get(self, job_id):
+        job = ImportJob.query.get(job_id)
+        if not job:
+            raise NotFoundException(ImportJob)
+        return job
+
+
 api.add_resource(ProjectListView, '/projects')
 api.add_resource(ProjectView, '/projects/<int:project_id>')
+api.add_resource(ProjectExportView, '/projects/export')
+api.add_resource(ProjectAggregateView, '/projects/aggregates')
+api.add_resource(ImportJobView, '/imports/<int:job_id>')
@@ -2,6 +2,7 @@ from flask import Blueprint
 from flask_restful import Api, fields, marshal_with, Resource, reqparse
 from app.common.auth import auth
 from app.common.exceptions import InvalidUsage
+from app.common.serializer import compile_fields
 from app.common.validator import email
 from app.models import db, User
 
@@ -18,12 +19,13 @@ user_fields = {
 user_fields_w_token = user_fields.copy()
 user_fields_w_token['token'] = fields.String
 
+serialize_users = compile_fields(user_fields)
+
 
 class UserListView(Resource):
     @auth.admin_required
-    @marshal_with(user_fields)
     def get(self):
-        return User.query.all()
+        return serialize_users(User.query.all())
 
     @marshal_with(user_fields)
     def post(self):
@@ -51,7 +53,7 @@ class UserView(Resource):
     @auth.login_required
     @marshal_with(user_fields_w_token)
     def get(self):
-        return auth.current_user
+        return auth.load_current_user()
 
     @auth.login_required
     @marshal_with(user_fields)
@@ -62,7 +64,7 @@ class UserView(Resource):
         parser.add_argument('full_name', type=str)
         args = parser.parse_args()
 
-        user = auth.current_user
+        user = auth.load_current_user()
 
         for k, v in args.items():
             if v is not None:
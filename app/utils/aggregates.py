@@ -0,0 +1,171 @@
+import math
+from collections import defaultdict
+from contextlib import contextmanager
+from sqlalchemy import and_, event, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from app.models import db, Project, Marker, ProjectAggregate
+
+METRICS = (
+    'project_count', 'floor_area', 'power_points_count', 'pedestal_big_count',
+    'pedestal_small_count', 'monitor_count', 'tv_count', 'table_count', 'chair_count'
+)
+COUNTED_COLUMNS = METRICS[2:]
+SNAPSHOT_CHUNK_SIZE = 500
+
+
+def project_values(space_x, space_y, *counts):
+    """ What one project adds to each metric. """
+    return (1, (space_x or 0) * (space_y or 0)) + tuple(c or 0 for c in counts)
+
+
+def snapshot(connection, project_ids=None):
+    """
+    Read {project_id: (type, values, map_ids)} for `project_ids`, or for
+    every project when None, as currently stored in the database.
+    """
+    project, marker = Project.__table__, Marker.__table__
+    q = select([
+        project.c.id, project.c.type, project.c.space_x, project.c.space_y,
+        *(project.c[c] for c in COUNTED_COLUMNS), marker.c.map_id
+    ]).select_from(project.outerjoin(marker, marker.c.project_id == project.c.id))
+
+    if project_ids is None:
+        chunks = [q]
+    else:
+        project_ids = sorted(project_ids)
+        chunks = [q.where(project.c.id.in_(project_ids[i:i + SNAPSHOT_CHUNK_SIZE]))
+                  for i in range(0, len(project_ids), SNAPSHOT_CHUNK_SIZE)]
+
+    projects = {}
+    for chunk in chunks:
+        for project_id, project_type, *values, map_id in connection.execute(chunk):
+            if project_id not in projects:
+                projects[project_id] = (project_type, project_values(*values), [])
+            if map_id is not None:
+                projects[project_id][2].append(map_id)
+    return projects
+
+
+def totals(projects):
+    """ Sum snapshot entries into {(scope, name): values}. """
+    grouped = defaultdict(list)
+    for project_type, values, map_ids in projects.values():
+        grouped[('type', project_type or '')].append(values)
+        for map_id in map_ids:
+            grouped[('map', str(map_id))].append(values)
+    result = {key: [sum(column) for column in zip(*rows)] for key, rows in grouped.items()}
+    types = [values for (scope, _), values in result.items() if scope == 'type']
+    if types:
+        result[('total', '')] = [sum(column) for column in zip(*types)]
+    return result
+
+
+def apply(connection, before, after):
+    """ Move the stored aggregates from snapshot `before` to snapshot `after`. """
+    old, new = totals(before), totals(after)
+    table = ProjectAggregate.__table__
+    changed = False
+    for scope, name in old.keys() | new.keys():
+        delta = [b - a for a, b in zip(old.get((scope, name), [0] * len(METRICS)),
+                                       new.get((scope, name), [0] * len(METRICS)))]
+        if not any(delta):
+            continue
+        changed = True
+        update = table.update().where(
+            and_(table.c.scope == scope, table.c.name == name)
+        ).values({c: table.c[c] + d for c, d in zip(METRICS, delta)})
+        if connection.execute(update).rowcount:
+            continue
+        try:
+            # a savepoint, so losing the race does not abort the transaction
+            with connection.begin_nested():
+                connection.execute(table.insert().values(
+                    scope=scope, name=name, **dict(zip(METRICS, delta))))
+        except IntegrityError:
+            # a concurrent transaction created the row first
+            connection.execute(update)
+    if changed:
+        connection.execute(table.delete().where(table.c.project_count <= 0))
+
+
+def add_projects(connection, mappings):
+    """ Count projects inserted with bulk_insert_mappings, which skips flush events. """
+    inserted = {i: (m.get('type'), project_values(
+        m.get('space_x'), m.get('space_y'), *(m.get(c) for c in COUNTED_COLUMNS)), [])
+        for i, m in enumerate(mappings)}
+    apply(connection, {}, inserted)
+
+
+def clear_scope(connection, scope):
+    table = ProjectAggregate.__table__
+    connection.execute(table.delete().where(table.c.scope == scope))
+
+
+@contextmanager
+def tracking(project_ids):
+    """ Keep the aggregates right around bulk statements on `project_ids`. """
+    connection = db.session.connection()
+    before = snapshot(connection, project_ids)
+    yield
+    apply(connection, before, snapshot(connection, project_ids))
+
+
+def differences(connection):
+    """ Stored aggregates that do not match a full recompute, as (key, stored, expected). """
+    expected = totals(snapshot(connection))
+    table = ProjectAggregate.__table__
+    stored = {(row.scope, row.name): [row[c] for c in METRICS]
+              for row in connection.execute(table.select())}
+    result = []
+    for key in sorted(stored.keys() | expected.keys()):
+        a, b = stored.get(key), expected.get(key)
+        if a is None or b is None or \
+                not all(math.isclose(x, y, rel_tol=1e-9, abs_tol=1e-6) for x, y in zip(a, b)):
+            result.append((key, a, b))
+    return result
+
+
+def rebuild(connection):
+    """ Replace the stored aggregates with a full recompute. """
+    table = ProjectAggregate.__table__
+    connection.execute(table.delete())
+    rows = [dict(scope=scope, name=name, **dict(zip(METRICS, values)))
+            for (scope, name), values in totals(snapshot(connection)).items()]
+    if rows:
+        connection.execute(table.insert(), rows)
+
+
+def _touched_project_ids(session):
+    """ Projects and ids whose aggregate contribution a flush may change. """
+    projects, project_ids = [], set()
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, Project):
+            projects.append(obj)
+        elif isinstance(obj, Marker):
+            attrs = db.inspect(obj).attrs
+            project_ids.update(attrs.project_id.history.sum())
+            projects.extend(attrs.project.history.sum())
+    project_ids.update(p.id for p in projects if p is not None)
+    project_ids.discard(None)
+    return [p for p in projects if p is not None], project_ids
+
+
+@event.listens_for(Session, 'before_flush')
+def _before_flush(session, flush_context, instances):
+    projects, project_ids = _touched_project_ids(session)
+    if projects or project_ids:
+        session.info['aggregates'] = (
+            projects, project_ids, snapshot(session.connection(), project_ids))
+
+
+@event.listens_for(Session, 'after_flush')
+def _after_flush(session, flush_context):
+    captured = session.info.pop('aggregates', None)
+    if captured is None:
+        return
+    projects, project_ids, before = captured
+    # new projects only have an id now
+    project_ids = project_ids | {p.id for p in projects if p.id is not None}
+    connection = session.connection()
+    apply(connection, before, snapshot(connection, project_ids))
@@ -1,5 +1,6 @@
 import math
 import numpy as np
+from sqlalchemy.orm import selectinload
 from app.models import db, Marker, Project, Map
 
 
@@ -155,7 +156,8 @@ def allocate():
         BoothCluster(maps[1], (2940, 2670), (3460, 2200), 40),
     ])
     skipped = []
-    for project in Project.query.all():
+    # skipped projects are marshalled with `allocated`, load their markers up front
+    for project in Project.query.options(selectinload(Project.marker)).all():
         allocated_map, allocated_polygon = allocator.allocate(project)
         if not allocated_map:
             skipped.append(project)
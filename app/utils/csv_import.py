@@ -0,0 +1,253 @@
+import csv
+import logging
+import re
+import string
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.exc import SQLAlchemyError
+from app.common.exceptions import InvalidUsage
+from app.models import db, Project, ImportJob
+from app.utils.aggregates import add_projects
+
+MAX_REPORTED_ERRORS = 100
+_LINES = re.compile(r'[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+')
+
+
+class ProjectRowParser:
+    """
+    Turn one CSV row into Project attributes. Regexes, translation tables
+    and the column mapping are prepared once instead of on every row.
+    """
+
+    NUMBER = re.compile(r"\d+\.?\d*")
+    NON_PRINTABLE = re.compile('[^' + re.escape(string.printable) + ']')
+    ASCII_NON_PRINTABLE = {c: None for c in range(128) if chr(c) not in string.printable}
+
+    def __init__(self):
+        self.columns = (
+            (5, int, 'power_points_count'),
+            (6, int, 'pedestal_big_count'),
+            (7, int, 'pedestal_small_count'),
+            (8, self.text, 'pedestal_description'),
+            (9, int, 'monitor_count'),
+            (10, int, 'tv_count'),
+            (11, int, 'table_count'),
+            (12, int, 'chair_count'),
+            (13, int, 'hdmi_to_vga_adapter_count'),
+            (14, int, 'hdmi_cable_count'),
+            (16, self.text, 'remark')
+        )
+
+    def text(self, text, length_limit=-1):
+        """ Keep printable ASCII characters only. """
+        text = str(text)
+        if text.isascii():
+            text = text.translate(self.ASCII_NON_PRINTABLE)
+        else:
+            text = self.NON_PRINTABLE.sub('', text)
+        if length_limit > 0:
+            text = text[:length_limit]
+        return text
+
+    def numbers(self, text):
+        numbers = [float(s) for s in self.NUMBER.findall(text)]
+        return numbers
+
+    def __call__(self, line):
+        if len(line) < 4:
+            raise InvalidUsage(
+                'At least 4 columns (name, type, type description, space requirement)'
+                + 'are required for CSV file')
+        result = {}
+        result['name'] = self.text(line[0], 127)
+        result['type'] = self.text(line[1] + ' ' + line[2], 127)
+        space_numbers = self.numbers(line[3])
+        if 'cm' in line[3]:
+            space_numbers = [n / 100 for n in space_numbers]
+        count = len(space_numbers)
+        result['space_x'] = space_numbers[0] if count > 0 else 2.0
+        result['space_y'] = space_numbers[1] if count > 1 else 2.0
+        result['space_z'] = space_numbers[2] if count > 2 else 2.0
+
+        # parse other optional parameters
+        if len(line) > 4:
+            prototype_nums = self.numbers(line[4])
+            count = len(prototype_nums)
+            result['prototype_weight'] = prototype_nums[3] if count > 3 else 0
+            if 'cm' in line[4]:
+                prototype_nums = [n / 100 for n in prototype_nums]
+            result['prototype_x'] = prototype_nums[0] if count > 0 else 0
+            result['prototype_y'] = prototype_nums[1] if count > 1 else 0
+            result['prototype_z'] = prototype_nums[2] if count > 2 else 0
+
+            for index, dtype, dkey in self.columns:
+                if index >= len(line):
+                    break
+                try:
+                    result[dkey] = dtype(line[index])
+                except Exception:
+                    pass
+        return result
+
+
+parse_project_row = ProjectRowParser()
+
+
+class ImportResult:
+    def __init__(self):
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+
+    def add_error(self, first_line, last_line, message, count=1):
+        self.failed += count
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({
+                'first_line': first_line,
+                'last_line': last_line,
+                'message': message
+            })
+
+
+def _insert_chunk(chunk, result: ImportResult):
+    if not chunk:
+        return
+    try:
+        mappings = [data for _, data in chunk]
+        db.session.bulk_insert_mappings(Project, mappings)
+        add_projects(db.session.connection(), mappings)
+        db.session.commit()
+        result.imported += len(chunk)
+    except SQLAlchemyError as e:
+        logging.exception(e)
+        db.session.rollback()
+        result.add_error(chunk[0][0], chunk[-1][0], 'Database error', len(chunk))
+
+
+def _decoded_lines(stream):
+    """
+    Lines of a binary upload split on CR LF, CR or LF, endings kept, as
+    open(..., newline='') would. Werkzeug's SpooledTemporaryFile has no
+    readable() before Python 3.11, so io.TextIOWrapper cannot wrap it. The
+    LF byte never occurs inside a UTF-8 character.
+    """
+    for line in stream:
+        line = line.decode('utf-8')
+        if '\r' in line:
+            yield from _LINES.findall(line)
+        else:
+            yield line
+
+
+def import_projects(stream, creator_id, parse_line=parse_project_row, chunk_size=1000,
+                    progress=None) -> ImportResult:
+    """
+    Parse a CSV upload straight from `stream` and bulk insert the projects
+    chunk by chunk. A bad row or a failed chunk is reported and skipped
+    instead of aborting the whole import. `progress` is called with the
+    result so far after every chunk.
+    """
+    reader = csv.reader(_decoded_lines(stream))
+    # skip headers
+    try:
+        next(reader)
+    except StopIteration:
+        raise InvalidUsage('One header line is expected')
+    except csv.Error as e:
+        logging.info(e)
+        raise InvalidUsage('Invalid CSV foramt')
+    except UnicodeDecodeError as e:
+        logging.info(e)
+        raise InvalidUsage('Invalid character in CSV file')
+
+    result = ImportResult()
+    chunk = []
+    try:
+        # go through every data line
+        for line in reader:
+            if not line:
+                continue
+            try:
+                data = parse_line(line)
+            except InvalidUsage as e:
+                result.add_error(reader.line_num, reader.line_num, e.message)
+                continue
+            except ValueError as e:
+                logging.info(e)
+                result.add_error(reader.line_num, reader.line_num, 'Invalid value')
+                continue
+            data['creator_id'] = creator_id
+            chunk.append((reader.line_num, data))
+            if len(chunk) >= chunk_size:
+                _insert_chunk(chunk, result)
+                chunk = []
+                if progress:
+                    progress(result)
+    except csv.Error as e:
+        logging.info(e)
+        result.add_error(reader.line_num, reader.line_num, 'Invalid CSV foramt')
+    except UnicodeDecodeError as e:
+        logging.info(e)
+        result.add_error(reader.line_num + 1, reader.line_num + 1, 'Invalid character in CSV file')
+    _insert_chunk(chunk, result)
+    return result
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor(app) -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                app.config.get('IMPORT_JOB_WORKERS', 1), thread_name_prefix='csv-import')
+        return _executor
+
+
+def _update_job(job: ImportJob, result: ImportResult):
+    job.rows_processed = result.imported + result.failed
+    job.rows_failed = result.failed
+    job.errors = result.errors
+    db.session.commit()
+
+
+def _run_import_job(app, job_id, upload, creator_id):
+    with app.app_context():
+        job = ImportJob.query.get(job_id)
+        try:
+            job.status = 'running'
+            db.session.commit()
+            result = import_projects(
+                upload, creator_id,
+                chunk_size=app.config['CSV_IMPORT_CHUNK_SIZE'],
+                progress=lambda result: _update_job(job, result))
+            job.status = 'finished'
+            _update_job(job, result)
+        except InvalidUsage as e:
+            job.status = 'failed'
+            job.message = e.message
+            db.session.commit()
+        except Exception as e:
+            logging.exception(e)
+            db.session.rollback()
+            job.status = 'failed'
+            job.message = 'Import failed'
+            db.session.commit()
+        finally:
+            upload.close()
+            db.session.remove()
+
+
+def submit_import_job(app, upload, creator_id) -> ImportJob:
+    """
+    Queue `upload`, a seekable file owned by the job from now on, for
+    import in a background thread. Progress is kept in the ImportJob row
+    so any worker process can report it.
+    """
+    job = ImportJob(creator_id=creator_id)
+    db.session.add(job)
+    db.session.commit()
+    _get_executor(app).submit(_run_import_job, app, job.id, upload, creator_id)
+    return job
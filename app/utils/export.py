@@ -0,0 +1,78 @@
+import csv
+import io
+import json
+from sqlalchemy import case
+from app.models import db, Project, Marker, Map
+from app.utils import geometry
+
+EXPORT_CHUNK_SIZE = 1000
+
+project_columns = tuple(Project.__table__.columns)
+allocation_columns = ('map_id', 'map_name', 'marker_id', 'centre_x', 'centre_y')
+export_columns = tuple(c.name for c in project_columns) + ('allocated',) + allocation_columns
+
+
+def export_rows(chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield one tuple per project, in `export_columns` order, reading plain
+    columns from a server-side cursor so memory stays constant.
+    """
+    # polygons are only read for markers whose centre is not backfilled yet
+    legacy = Marker.centre_x.is_(None)
+    q = db.session.query(
+        *project_columns,
+        Map.id, Map.name, Marker.id, Marker.centre_x, Marker.centre_y,
+        case([(legacy, Marker.polygon_blob)]), case([(legacy, Marker.polygon_json)])
+    ).outerjoin(Marker, Marker.project_id == Project.id) \
+        .outerjoin(Map, Marker.map_id == Map.id) \
+        .order_by(Project.id) \
+        .execution_options(stream_results=True) \
+        .yield_per(chunk_size)
+
+    project_count = len(project_columns)
+    for row in q:
+        map_id, map_name, marker_id, centre_x, centre_y, polygon_blob, polygon_json = row[project_count:]
+        centre = {'x': centre_x, 'y': centre_y}
+        if marker_id is not None and centre_x is None:
+            coords = geometry.unpack(polygon_blob) if polygon_blob is not None \
+                else geometry.from_json(polygon_json)
+            centre = geometry.centroid(coords) or centre
+        yield row[:project_count] + (
+            marker_id is not None, map_id, map_name, marker_id, centre['x'], centre['y'])
+
+
+def _chunked(rows, buffer, write, chunk_size):
+    """ Write rows into `buffer` and yield its content every `chunk_size` rows. """
+    for i, row in enumerate(rows, 1):
+        write(row)
+        if i % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _isoformat(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def to_csv(rows, chunk_size=EXPORT_CHUNK_SIZE):
+    """ Encode rows as CSV with a header line. """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(export_columns)
+
+    def write(row):
+        writer.writerow([_isoformat(v) for v in row])
+    yield from _chunked(rows, buffer, write, chunk_size)
+
+
+def to_ndjson(rows, chunk_size=EXPORT_CHUNK_SIZE):
+    """ Encode rows as newline delimited JSON objects. """
+    buffer = io.StringIO()
+
+    def write(row):
+        buffer.write(json.dumps(dict(zip(export_columns, row)), default=_isoformat))
+        buffer.write('\n')
+    yield from _chunked(rows, buffer, write, chunk_size)
@@ -0,0 +1,134 @@
+import json
+import sys
+from array import array
+import numpy as np
+
+# coordinates are stored as little-endian int32 pairs: x0, y0, x1, y1, ...
+COORDINATE_TYPE = 'i'
+COORDINATE_MIN, COORDINATE_MAX = -2 ** 31, 2 ** 31 - 1
+
+
+def pack(points) -> bytes:
+    """ Pack [{'x': .., 'y': ..}, ...] into the binary polygon format. """
+    coords = array(COORDINATE_TYPE)
+    for point in points:
+        coords.append(int(point['x']))
+        coords.append(int(point['y']))
+    if sys.byteorder == 'big':
+        coords.byteswap()
+    return coords.tobytes()
+
+
+def unpack(blob: bytes) -> array:
+    """ Flat coordinate array of a packed polygon. """
+    coords = array(COORDINATE_TYPE)
+    coords.frombytes(blob)
+    if sys.byteorder == 'big':
+        coords.byteswap()
+    return coords
+
+
+def from_json(polygon_json: str) -> array:
+    """ Flat coordinate array of a polygon still stored as JSON text. """
+    coords = array(COORDINATE_TYPE)
+    for point in json.loads(polygon_json or '[]'):
+        coords.append(int(point['x']))
+        coords.append(int(point['y']))
+    return coords
+
+
+def to_points(coords):
+    return [{'x': coords[i], 'y': coords[i + 1]} for i in range(0, len(coords), 2)]
+
+
+def centroid(coords):
+    """
+    Area centroid of a flat coordinate array, truncated to integers.
+    Polygons without area use the mean of their vertices, points and lines
+    their first vertex, and an empty polygon has no centre.
+    """
+    n = len(coords) // 2
+    if n >= 3:
+        cx, cy, area = 0.0, 0.0, 0.0
+        for i in range(n):
+            x_i, y_i = coords[2 * i], coords[2 * i + 1]
+            j = (i + 1) % n
+            x_ip1, y_ip1 = coords[2 * j], coords[2 * j + 1]
+            cross = x_i * y_ip1 - x_ip1 * y_i
+            cx += (x_i + x_ip1) * cross
+            cy += (y_i + y_ip1) * cross
+            area += 0.5 * cross
+        if area:
+            cx /= 6 * area
+            cy /= 6 * area
+            return {'x': int(cx), 'y': int(cy)}
+        return {'x': int(sum(coords[0::2]) / n), 'y': int(sum(coords[1::2]) / n)}
+    if n:
+        return {'x': coords[0], 'y': coords[1]}
+    return None
+
+
+def bounds(coords):
+    """ (min_x, min_y, max_x, max_y) of a flat coordinate array, None if empty. """
+    if not coords:
+        return None
+    xs, ys = coords[0::2], coords[1::2]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def derived_columns(coords):
+    """ Marker centre and bounding box columns for a flat coordinate array. """
+    centre = centroid(coords) or {'x': None, 'y': None}
+    min_x, min_y, max_x, max_y = bounds(coords) or (None, None, None, None)
+    return {
+        'centre_x': centre['x'], 'centre_y': centre['y'],
+        'min_x': min_x, 'min_y': min_y, 'max_x': max_x, 'max_y': max_y
+    }
+
+
+def _segment_distances(points, start, end):
+    """ Distances of `points` to the segment from `start` to `end`. """
+    direction = end - start
+    length = np.dot(direction, direction)
+    if length == 0:
+        return np.hypot(*(points - start).T)
+    t = np.clip((points - start) @ direction / length, 0, 1)
+    return np.hypot(*(points - (start + t[:, None] * direction)).T)
+
+
+def simplify(coords, tolerance):
+    """
+    Douglas-Peucker simplification of a closed polygon given as a flat
+    coordinate array. Vertices closer than `tolerance` to the simplified
+    outline are dropped, at least a triangle is kept.
+    """
+    points = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    n = len(points)
+    if n <= 3 or tolerance <= 0:
+        return to_points(coords)
+
+    # split the ring at the vertex farthest from the first one
+    far = int(np.argmax(_segment_distances(points, points[0], points[0])))
+    keep = np.zeros(n + 1, dtype=bool)
+    keep[[0, far, n]] = True
+    ring = np.vstack([points, points[:1]])
+
+    stack = [(0, far), (far, n)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        distances = _segment_distances(ring[first + 1:last], ring[first], ring[last])
+        i = int(np.argmax(distances))
+        if distances[i] > tolerance:
+            split = first + 1 + i
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+
+    kept = np.flatnonzero(keep[:n])
+    if len(kept) < 3:
+        # keep the vertex farthest from the remaining line to stay a polygon
+        distances = _segment_distances(points, points[0], points[far])
+        kept = np.sort(np.append(kept, int(np.argmax(distances))))
+    return [{'x': int(x), 'y': int(y)} for x, y in ring[kept].astype(np.int64)]
@@ -0,0 +1,175 @@
+import threading
+from collections import defaultdict
+from app.models import db, Marker, ChangeCounter
+from app.utils import geometry
+
+
+def contains(coords, x, y) -> bool:
+    """ Even-odd point in polygon test on a flat coordinate array. """
+    n = len(coords) // 2
+    inside = False
+    j = n - 1
+    for i in range(n):
+        x_i, y_i = coords[2 * i], coords[2 * i + 1]
+        x_j, y_j = coords[2 * j], coords[2 * j + 1]
+        if (y_i > y) != (y_j > y) and x < (x_j - x_i) * (y - y_i) / (y_j - y_i) + x_i:
+            inside = not inside
+        j = i
+    return inside
+
+
+class GridIndex:
+    """
+    Uniform grid over marker bounding boxes, for point queries. Markers
+    spanning more than `max_cells` cells are kept in an overflow set that
+    is checked on every query instead of filling the grid.
+    """
+
+    def __init__(self, cell_size=256, max_cells=1024):
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+        self.cells = defaultdict(set)
+        self.overflow = set()
+        self.markers = {}
+
+    def _cell_range(self, bounds):
+        return tuple(int(v // self.cell_size) for v in bounds)
+
+    def _cells(self, bounds):
+        min_x, min_y, max_x, max_y = self._cell_range(bounds)
+        return [(i, j) for i in range(min_x, max_x + 1) for j in range(min_y, max_y + 1)]
+
+    def _overflows(self, bounds):
+        min_x, min_y, max_x, max_y = self._cell_range(bounds)
+        return (max_x - min_x + 1) * (max_y - min_y + 1) > self.max_cells
+
+    def insert(self, marker_id, coords):
+        self.remove(marker_id)
+        bounds = geometry.bounds(coords)
+        if bounds is None:
+            return
+        self.markers[marker_id] = (bounds, coords)
+        if self._overflows(bounds):
+            self.overflow.add(marker_id)
+            return
+        for cell in self._cells(bounds):
+            self.cells[cell].add(marker_id)
+
+    def remove(self, marker_id):
+        entry = self.markers.pop(marker_id, None)
+        if entry is None:
+            return
+        if marker_id in self.overflow:
+            self.overflow.discard(marker_id)
+            return
+        for cell in self._cells(entry[0]):
+            self.cells[cell].discard(marker_id)
+            if not self.cells[cell]:
+                del self.cells[cell]
+
+    def query(self, x, y):
+        """ Ids of the markers whose polygon contains the point. """
+        cell = (int(x // self.cell_size), int(y // self.cell_size))
+        result = []
+        for marker_id in (*self.cells.get(cell, ()), *self.overflow):
+            (min_x, min_y, max_x, max_y), coords = self.markers[marker_id]
+            if min_x <= x <= max_x and min_y <= y <= max_y and contains(coords, x, y):
+                result.append(marker_id)
+        return sorted(result)
+
+    def __len__(self):
+        return len(self.markers)
+
+
+class MarkerIndexes:
+    """
+    One GridIndex per map, built on first use. Each index remembers the
+    change counters it reflects, so writes from other processes make it
+    rebuild while the views' own writes are applied in place.
+    """
+
+    def __init__(self, cell_size=256):
+        self.cell_size = cell_size
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.cell_size = app.config.get('SPATIAL_GRID_CELL_SIZE', 256)
+        self.clear()
+
+    @staticmethod
+    def _version(map_id):
+        return ChangeCounter.current(f'marker:{map_id}', 'marker:*')
+
+    def _build(self, map_id):
+        index = GridIndex(self.cell_size)
+        markers = db.session.query(Marker.id, Marker.polygon_blob, Marker.polygon_json) \
+            .filter(Marker.map_id == map_id)
+        for marker_id, polygon_blob, polygon_json in markers:
+            index.insert(marker_id, geometry.unpack(polygon_blob) if polygon_blob is not None
+                         else geometry.from_json(polygon_json))
+        return index
+
+    def get(self, map_id) -> GridIndex:
+        with self._lock:
+            version = self._version(map_id)
+            entry = self._indexes.get(map_id)
+            if entry is None or entry[0] != version:
+                # read the version first, a change in between only causes another rebuild
+                entry = (version, self._build(map_id))
+                self._indexes[map_id] = entry
+            return entry[1]
+
+    def _apply(self, map_id, update):
+        """ Apply the writes of one commit to the index of `map_id`. """
+        if map_id is None:
+            return
+        with self._lock:
+            entry = self._indexes.get(map_id)
+            if entry is None:
+                return
+            (version, bulk_version), index = entry
+            current = self._version(map_id)
+            if current == (version, bulk_version):
+                return
+            if current == (version + 1, bulk_version):
+                update(index)
+                self._indexes[map_id] = (current, index)
+            else:
+                del self._indexes[map_id]
+
+    def applied(self, upserts=(), deletes=()):
+        """
+        Update the indexes after a commit. `upserts` are (marker_id, map_id,
+        old_map_id, coordinates), old_map_id being None for new markers,
+        and `deletes` are (map_id, marker_id) pairs.
+        """
+        updates = defaultdict(list)
+        for marker_id, map_id, old_map_id, coords in upserts:
+            if old_map_id is not None and old_map_id != map_id:
+                updates[old_map_id].append((GridIndex.remove, (marker_id,)))
+            updates[map_id].append((GridIndex.insert, (marker_id, coords)))
+        for map_id, marker_id in deletes:
+            updates[map_id].append((GridIndex.remove, (marker_id,)))
+
+        for map_id, operations in updates.items():
+            def update(index, operations=operations):
+                for operation, args in operations:
+                    operation(index, *args)
+            self._apply(map_id, update)
+
+    def added(self, marker):
+        self.changed(marker, None)
+
+    def changed(self, marker, old_map_id):
+        self.applied(upserts=[(marker.id, marker.map_id, old_map_id, marker.coordinates)])
+
+    def removed(self, map_id, marker_id):
+        self.applied(deletes=[(map_id, marker_id)])
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+
+
+marker_indexes = MarkerIndexes()
@@ -1,10 +1,9 @@
-import tempfile
-
-
 class Config():
     """ Common Config """
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    UPLOAD_FOLDER = tempfile.gettempdir()
+    CSV_IMPORT_CHUNK_SIZE = 1000
+    IMPORT_JOB_WORKERS = 1
+    MAX_PAGE_SIZE = 1000
 
     PASSLIB_CONTEXT_CONFIG = '\n'.join([
         '[passlib]',
@@ -15,6 +14,47 @@ class Config():
         'admin__sha256_crypt__min_rounds = 1024000',
         'admin__sha512_crypt__min_rounds = 1024000',
     ])
+    # File with a passlib context, e.g. written by `flask calibrate-hashing`,
+    # used instead of PASSLIB_CONTEXT_CONFIG when set
+    PASSLIB_CONTEXT_PATH = None
+
+    # Process pool for hashing/verifying passwords, 0 to hash inline.
+    # Requests beyond the queue limit are rejected with 503.
+    PASSWORD_HASH_WORKERS = 2
+    PASSWORD_HASH_QUEUE_LIMIT = 32
+
+    # Successful Basic auth verifications, keyed by user id
+    CREDENTIAL_CACHE_SIZE = 1024
+    CREDENTIAL_CACHE_TTL = 300  # in seconds
+
+    # Token buckets for Basic auth attempts: burst size and refill rate
+    LOGIN_RATE_LIMIT_ENABLED = True
+    LOGIN_RATE_LIMIT_EMAIL_BURST = 10
+    LOGIN_RATE_LIMIT_EMAIL_PER_MINUTE = 5
+    LOGIN_RATE_LIMIT_ADDRESS_BURST = 100
+    LOGIN_RATE_LIMIT_ADDRESS_PER_MINUTE = 60
+    LOGIN_RATE_LIMIT_MAX_BUCKETS = 10000
+
+    # Reverse proxies in front of the app. Set it when deployed behind one,
+    # so address buckets see X-Forwarded-For rather than the proxy address.
+    PROXY_FIX_X_FOR = 0
+
+    # Trust id/is_admin claims carried by bearer tokens instead of loading
+    # the User row on every request. Role changes then apply on token expiry.
+    STATELESS_TOKEN_AUTH = False
+
+    # Grid cell size, in map pixels, of the in-memory marker hit-test index
+    SPATIAL_GRID_CELL_SIZE = 256
+
+    # Markers whose simplified polygons (?tolerance=) are kept in memory
+    POLYGON_CACHE_SIZE = 4096
+
+    # Serialized map and marker list responses kept per worker
+    RESPONSE_CACHE_SIZE = 128
+
+    # Longest ?wait= of the marker change feed and how often it polls, in seconds
+    MARKER_FEED_MAX_WAIT = 25
+    MARKER_FEED_POLL_INTERVAL = 1.0
 
 
 class DevelopmentConfig(Config):
@@ -1,4 +1,6 @@
 import random
+from contextlib import contextmanager
+from sqlalchemy import event
 from config import Config
 from app import create_app
 from app.models import db
@@ -24,6 +26,21 @@ class TestBase:
         self._app_context.pop()
 
 
+@contextmanager
+def count_queries():
+    """ Collect the SQL statements executed inside the block. """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
 class MutationOperator:
     def mutate(self, line):
         raise NotImplementedError()
@@ -79,3 +96,12 @@ mutator = MultiMutator([
     BitFlipMutator(),
     TrimMutator()
 ])
+
+
+@contextmanager
+def assert_num_queries(expected):
+    """ Fail unless exactly `expected` SQL statements run inside the block. """
+    with count_queries() as statements:
+        yield statements
+    assert len(statements) == expected, \
+        'expected {} statements, got {}:\n{}'.format(expected, len(statements), '\n'.join(statements))
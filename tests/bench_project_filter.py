@@ -0,0 +1,62 @@
+import random
+import time
+from tests import TestBase
+from app.common.filters import prefix_filter
+from app.models import db, Project
+from app.resources.project import project_filters
+
+PROJECT_COUNT = 100000
+
+
+def timed(query, repeat=20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        rows = query.all()
+    return (time.perf_counter() - start) / repeat * 1000, len(rows)
+
+
+def query_plan(query):
+    statement = query.statement.compile(db.engine, compile_kwargs={'literal_binds': True})
+    return [row[-1] for row in db.session.execute('EXPLAIN QUERY PLAN ' + str(statement))]
+
+
+class TestProjectFilterBenchmark(TestBase):
+    def setup_class(self):
+        super().setup_class(self)
+        random.seed(0)
+        types = ['Prototype', 'Software', 'Light installation', 'Physical showroom']
+        db.session.bulk_insert_mappings(Project, [{
+            'name': 'Project {:06d}'.format(i),
+            'type': random.choice(types),
+            'space_x': random.randint(1, 20),
+            'space_y': random.randint(1, 20),
+            'space_z': random.randint(1, 5),
+            'monitor_count': random.randint(0, 4),
+            'remark': 'Remark {}'.format(i)
+        } for i in range(PROJECT_COUNT)])
+        db.session.commit()
+
+    def compare(self, title, legacy, typed):
+        legacy_ms, legacy_rows = timed(legacy)
+        typed_ms, typed_rows = timed(typed)
+        print('\n{}: LIKE {:.2f} ms ({} rows), typed {:.2f} ms ({} rows)'.format(
+            title, legacy_ms, legacy_rows, typed_ms, typed_rows))
+        print('  plan:', '; '.join(query_plan(typed)))
+
+    def test_name_prefix(self):
+        self.compare(
+            'name',
+            Project.query.filter(Project.name.like('%Project 04213%')),
+            Project.query.filter(prefix_filter(Project.name, 'Project 04213')))
+
+    def test_space_range(self):
+        self.compare(
+            'space_x',
+            Project.query.filter(Project.space_x.like('%19%')),
+            project_filters.apply(Project.query, {'space_x': 19.0}))
+
+    def test_remark_prefix(self):
+        self.compare(
+            'remark',
+            Project.query.filter(Project.remark.like('%Remark 9999%')),
+            project_filters.apply(Project.query, {'remark': 'Remark 9999'}))
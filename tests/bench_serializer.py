@@ -0,0 +1,32 @@
+import time
+from flask_restful import marshal
+from app.common.serializer import compile_fields
+from app.resources.marker import marker_field
+from app.resources.project import project_fields
+from tests.test_serializer import sample_markers, sample_projects
+
+OBJECT_COUNT = 10000
+
+
+def compare(title, objects, fields):
+    serialize = compile_fields(fields)
+    timings = {}
+    for name, run in [('marshal', lambda: marshal(objects, fields)), ('compiled', lambda: serialize(objects))]:
+        start = time.perf_counter()
+        run()
+        timings[name] = (time.perf_counter() - start) * 1000
+    print('\n{}: marshal {:.1f} ms, compiled {:.1f} ms ({:.1f}x)'.format(
+        title, timings['marshal'], timings['compiled'], timings['marshal'] / timings['compiled']))
+    return timings
+
+
+class TestSerializerBenchmark:
+    def test_projects(self):
+        projects = (sample_projects() * OBJECT_COUNT)[:OBJECT_COUNT]
+        timings = compare('projects', projects, project_fields)
+        assert timings['compiled'] < timings['marshal']
+
+    def test_markers(self):
+        markers = (sample_markers() * OBJECT_COUNT)[:OBJECT_COUNT]
+        timings = compare('markers', markers, marker_field)
+        assert timings['compiled'] < timings['marshal']
@@ -0,0 +1,115 @@
+import csv
+import io
+import random
+import re
+import string
+import time
+from tests.fuzz_test_csv import fuzz_csv
+from app.common.exceptions import InvalidUsage
+from app.utils.csv_import import parse_project_row
+
+
+def legacy_ascii_str(text, length_limit=-1):
+    text = str(text)
+    text = ''.join(filter(lambda c: c in set(string.printable), text))
+    if length_limit > 0:
+        text = text[:length_limit]
+    return text
+
+
+def legacy_parse_csv_line(line):
+    """ The row parser ProjectListView used before ProjectRowParser. """
+    if len(line) < 4:
+        raise InvalidUsage(
+            'At least 4 columns (name, type, type description, space requirement)'
+            + 'are required for CSV file')
+    result = {}
+    result['name'] = legacy_ascii_str(line[0], 127)
+    result['type'] = legacy_ascii_str(line[1] + ' ' + line[2], 127)
+    space_numbers = [float(s) for s in re.findall(r"\d+\.?\d*", line[3])]
+    use_cm = 'cm' in line[3]
+    if use_cm:
+        space_numbers = [n / 100 for n in space_numbers]
+    result['space_x'] = space_numbers[0] if len(space_numbers) > 0 else 2.0
+    result['space_y'] = space_numbers[1] if len(space_numbers) > 1 else 2.0
+    result['space_z'] = space_numbers[2] if len(space_numbers) > 2 else 2.0
+
+    if len(line) > 4:
+        prototype_nums = [float(s) for s in re.findall(r"\d+\.?\d*", line[4])]
+        use_cm = 'cm' in line[4]
+        result['prototype_weight'] = prototype_nums[3] if len(prototype_nums) > 3 else 0
+        if use_cm:
+            prototype_nums = [n / 100 for n in prototype_nums]
+        result['prototype_x'] = prototype_nums[0] if len(prototype_nums) > 0 else 0
+        result['prototype_y'] = prototype_nums[1] if len(prototype_nums) > 1 else 0
+        result['prototype_z'] = prototype_nums[2] if len(prototype_nums) > 2 else 0
+
+        mapping = {
+            5: (int, 'power_points_count'),
+            6: (int, 'pedestal_big_count'),
+            7: (int, 'pedestal_small_count'),
+            8: (legacy_ascii_str, 'pedestal_description'),
+            9: (int, 'monitor_count'),
+            10: (int, 'tv_count'),
+            11: (int, 'table_count'),
+            12: (int, 'chair_count'),
+            13: (int, 'hdmi_to_vga_adapter_count'),
+            14: (int, 'hdmi_cable_count'),
+            16: (legacy_ascii_str, 'remark')
+        }
+        for i in range(5, len(line)):
+            if i in mapping:
+                dtype = mapping[i][0]
+                dkey = mapping[i][1]
+                try:
+                    dvalue = dtype(line[i])
+                    result[dkey] = dvalue
+                except Exception:
+                    pass
+    return result
+
+
+def parse_or_error(parse, line):
+    try:
+        return parse(line)
+    except InvalidUsage as e:
+        return e.message
+    except ValueError as e:
+        return type(e)
+
+
+def read_rows(text):
+    try:
+        return list(csv.reader(io.StringIO(text, newline='')))
+    except csv.Error:
+        return []
+
+
+class TestRowParser:
+    def setup_class(self):
+        self.template = open('tests/project_requirements.csv', 'r').read()
+
+    def test_template(self):
+        for line in read_rows(self.template)[1:]:
+            assert parse_project_row(line) == legacy_parse_csv_line(line)
+
+    def test_fuzz_equivalence(self):
+        random.seed(0)
+        last_csv = self.template
+        for _ in range(100):
+            random_csv = fuzz_csv(self.template if random.random() < 0.5 else last_csv)
+            last_csv = random_csv
+            for line in read_rows(random_csv):
+                assert parse_or_error(parse_project_row, line) == \
+                    parse_or_error(legacy_parse_csv_line, line), line
+
+    def test_benchmark(self):
+        rows = [line for line in read_rows(self.template)[1:] if len(line) >= 4] * 100
+        rates = {}
+        for name, parse in [('legacy', legacy_parse_csv_line), ('compiled', parse_project_row)]:
+            start = time.perf_counter()
+            for line in rows:
+                parse(line)
+            rates[name] = len(rows) / (time.perf_counter() - start)
+            print('{}: {:.0f} rows/sec'.format(name, rates[name]))
+        assert rates['compiled'] > rates['legacy']
@@ -0,0 +1,142 @@
+import json
+import math
+import random
+import time
+from app.common.cache import polygon_cache
+from app.models import Marker
+from app.utils import geometry
+
+
+def legacy_centre(coords):
+    """ Marker.centre before polygons were stored packed. """
+    if len(coords) >= 3:
+        cx, cy, area = 0.0, 0.0, 0.0
+        for i in range(len(coords)):
+            x_i = coords[i]['x']
+            y_i = coords[i]['y']
+            x_ip1 = coords[(i+1) % len(coords)]['x']
+            y_ip1 = coords[(i+1) % len(coords)]['y']
+            cx += (x_i + x_ip1) * (x_i * y_ip1 - x_ip1 * y_i)
+            cy += (y_i + y_ip1) * (x_i * y_ip1 - x_ip1 * y_i)
+            area += 0.5 * (x_i * y_ip1 - x_ip1 * y_i)
+        cx /= 6 * area
+        cy /= 6 * area
+        return {
+            'x': int(cx),
+            'y': int(cy)
+        }
+    else:
+        return coords[0]
+
+
+def random_polygon(size, radius=5000):
+    return [{'x': random.randint(-radius, radius), 'y': random.randint(-radius, radius)}
+            for _ in range(size)]
+
+
+class TestGeometry:
+    def test_pack_round_trip(self):
+        points = [{'x': 0, 'y': 0}, {'x': -1, 'y': 2 ** 31 - 1}, {'x': 12.7, 'y': '3'}]
+        blob = geometry.pack(points)
+        assert len(blob) == 8 * len(points)
+        assert blob[:8] == b'\x00' * 8
+        assert geometry.to_points(geometry.unpack(blob)) == [
+            {'x': 0, 'y': 0}, {'x': -1, 'y': 2 ** 31 - 1}, {'x': 12, 'y': 3}]
+        assert geometry.from_json(json.dumps(points)) == geometry.unpack(blob)
+
+    def test_centroid_matches_legacy(self):
+        random.seed(18)
+        for _ in range(200):
+            points = random_polygon(random.randint(1, 50))
+            try:
+                expected = legacy_centre(points)
+            except ZeroDivisionError:
+                continue
+            assert geometry.centroid(geometry.unpack(geometry.pack(points))) == expected
+        assert geometry.centroid(geometry.unpack(b'')) is None
+
+    def test_degenerate_polygons(self):
+        line = geometry.unpack(geometry.pack([{'x': 0, 'y': 0}, {'x': 10, 'y': 10}, {'x': 20, 'y': 20}]))
+        assert geometry.centroid(line) == {'x': 10, 'y': 10}
+        assert geometry.bounds(line) == (0, 0, 20, 20)
+        assert geometry.bounds(geometry.unpack(b'')) is None
+
+    def test_marker_geometry_columns(self):
+        marker = Marker(polygon=[{'x': 0, 'y': 0}, {'x': 100, 'y': 0}, {'x': 100, 'y': 50}, {'x': 0, 'y': 50}])
+        assert (marker.centre_x, marker.centre_y) == (50, 25)
+        assert (marker.min_x, marker.min_y, marker.max_x, marker.max_y) == (0, 0, 100, 50)
+        assert marker.centre == {'x': 50, 'y': 25}
+        marker.polygon = []
+        assert marker.centre is None
+        assert marker.min_x is None
+
+    def test_marker_reads_both_formats(self):
+        points = random_polygon(20)
+        legacy = Marker(polygon_json=json.dumps(points))
+        packed = Marker(polygon=points)
+        assert packed.polygon_json is None
+        assert legacy.polygon == packed.polygon == points
+        assert legacy.centre == packed.centre
+
+    def test_size_and_decode_time(self):
+        points = random_polygon(2000)
+        polygon_json = json.dumps(points)
+        blob = geometry.pack(points)
+        assert len(blob) < len(polygon_json) / 2
+
+        start = time.perf_counter()
+        for _ in range(50):
+            legacy_centre([{'x': int(p['x']), 'y': int(p['y'])} for p in json.loads(polygon_json)])
+        legacy = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(50):
+            geometry.centroid(geometry.unpack(blob))
+        packed = time.perf_counter() - start
+        print('\ncentre of 2000 points: json {:.2f} ms, packed {:.2f} ms, {} vs {} bytes'.format(
+            legacy * 20, packed * 20, len(polygon_json), len(blob)))
+        assert packed < legacy
+
+    def test_simplify_drops_collinear_vertices(self):
+        points = [{'x': x, 'y': 0} for x in range(0, 100, 10)] + \
+            [{'x': 100, 'y': y} for y in range(0, 100, 10)] + \
+            [{'x': x, 'y': 100} for x in range(100, 0, -10)] + \
+            [{'x': 0, 'y': y} for y in range(100, 0, -10)]
+        simplified = geometry.simplify(geometry.unpack(geometry.pack(points)), 1)
+        assert sorted((p['x'], p['y']) for p in simplified) == [(0, 0), (0, 100), (100, 0), (100, 100)]
+
+    def test_simplify_within_tolerance(self):
+        random.seed(22)
+        for _ in range(5):
+            # a noisy circle
+            points = [{'x': int(1000 + 500 * math.cos(a) + random.randint(-5, 5)),
+                       'y': int(1000 + 500 * math.sin(a) + random.randint(-5, 5))}
+                      for a in [i * 2 * math.pi / 200 for i in range(200)]]
+            coords = geometry.unpack(geometry.pack(points))
+            for tolerance in (2, 8, 64, 1024):
+                simplified = geometry.simplify(coords, tolerance)
+                assert 3 <= len(simplified) < len(points)
+                # kept vertices are original ones, in order
+                positions = [points.index(p) for p in simplified]
+                assert positions == sorted(positions)
+                outline = simplified + simplified[:1]
+                for point in points:
+                    distance = min(_segment_distance(point, a, b) for a, b in zip(outline, outline[1:]))
+                    assert distance <= tolerance or tolerance == 1024
+
+    def test_simplified_polygon_cache(self):
+        points = [{'x': x, 'y': 0} for x in range(0, 100, 10)] + [{'x': 100, 'y': 100}, {'x': 0, 'y': 100}]
+        marker = Marker(id=2200, polygon=points)
+        first = marker.simplified_polygon(5)
+        assert len(first) == 4
+        assert marker.simplified_polygon(7) is first
+        assert marker.simplified_polygon(0.5) == points
+        marker.polygon = points[:3] + points[-2:]
+        assert marker.simplified_polygon(5) is not first
+        polygon_cache.invalidate(2200)
+
+
+def _segment_distance(p, a, b):
+    dx, dy = b['x'] - a['x'], b['y'] - a['y']
+    length = dx * dx + dy * dy
+    t = 0 if length == 0 else max(0, min(1, ((p['x'] - a['x']) * dx + (p['y'] - a['y']) * dy) / length))
+    return math.hypot(p['x'] - a['x'] - t * dx, p['y'] - a['y'] - t * dy)
@@ -1,6 +1,11 @@
 import json
-from tests import TestBase
-from app.models import db, User, Project, Map
+from sqlalchemy import event
+from tests import TestBase, count_queries
+from app.models import db, User, Project, Map, Marker, MarkerTombstone, ChangeCounter
+from app.commands import markers
+from app.utils import aggregates
+from app.utils.spatial import marker_indexes
+from app.common.cache import response_cache
 
 
 class TestMarker(TestBase):
@@ -55,6 +60,62 @@ class TestMarker(TestBase):
             'scale': 0.017
         }]
 
+    def test_get_maps_stateless_token(self):
+        token = self.student.token
+        response_cache.clear()
+        self.app.config['STATELESS_TOKEN_AUTH'] = True
+        try:
+            with count_queries() as statements:
+                rv = self.client.get(
+                    '/maps',
+                    headers={'Authorization': 'Bearer ' + token}
+                )
+            with count_queries() as cached:
+                self.client.get('/maps', headers={'Authorization': 'Bearer ' + token})
+        finally:
+            self.app.config['STATELESS_TOKEN_AUTH'] = False
+        assert rv.status_code == 200
+        assert len(rv.json) == 2
+        # the change counter read for the ETag, then the maps
+        assert len(statements) == 2
+        assert not any('user' in statement for statement in statements)
+        # a cached response only needs the counter
+        assert len(cached) == 1
+
+    def test_change_counter_created_concurrently(self):
+        table = ChangeCounter.__table__
+        raced = []
+
+        def insert_first(conn, cursor, statement, parameters, context, executemany):
+            # another transaction creates the row right after our UPDATE missed it
+            if not raced and statement.startswith('UPDATE change_counter') and cursor.rowcount == 0:
+                raced.append(statement)
+                conn.execute(table.insert().values(name='concurrent', value=5))
+
+        event.listen(db.engine, 'after_cursor_execute', insert_first)
+        try:
+            ChangeCounter.bump(db.session.connection(), {'concurrent'})
+        finally:
+            event.remove(db.engine, 'after_cursor_execute', insert_first)
+        assert raced
+        db.session.commit()
+        assert ChangeCounter.current('concurrent') == (6,)
+
+    def test_get_maps_not_modified(self):
+        rv = self.client.get('/maps', headers={'Authorization': 'Bearer ' + self.student.token})
+        assert rv.status_code == 200
+        etag = rv.headers['ETag']
+        token = self.student.token
+        with count_queries() as statements:
+            rv = self.client.get('/maps', headers={
+                'Authorization': 'Bearer ' + token,
+                'If-None-Match': etag
+            })
+        assert rv.status_code == 304
+        assert rv.data == b''
+        assert rv.headers['ETag'] == etag
+        assert not any('FROM map' in statement for statement in statements)
+
     def test_get_map_by_id(self):
         rv = self.client.get(
             '/maps/1',
@@ -101,6 +162,16 @@ class TestMarker(TestBase):
         )
         assert rv.status_code == 400
 
+    def test_post_marker_out_of_range(self):
+        rv = self.client.post(
+            '/maps/1/markers',
+            headers={'Authorization': 'Bearer ' + self.admin.token},
+            data={
+                'polygon_json': '[{"x": 500, "y": 500}, {"x": 99999999999, "y": 500}, {"x": 1000, "y": 1000}]'
+            }
+        )
+        assert rv.status_code == 400
+
     def test_post_marker_invalid_map(self):
         rv = self.client.post(
             '/maps/0/markers',  # 0 is an invalid map_id
@@ -139,6 +210,344 @@ class TestMarker(TestBase):
         assert rv.status_code == 200
         assert len(rv.json) == 1
 
+    def test_get_markers_fields(self):
+        with count_queries() as statements:
+            rv = self.client.get(
+                '/maps/1/markers?fields=id,map_id',
+                headers={'Authorization': 'Bearer ' + self.admin.token},
+            )
+        assert rv.status_code == 200
+        assert rv.json == [{'id': 1, 'map_id': 1}]
+        assert not any('polygon_json' in statement for statement in statements)
+
+    def test_get_markers_centre_only(self):
+        with count_queries() as statements:
+            rv = self.client.get(
+                '/maps/1/markers?fields=id,centre',
+                headers={'Authorization': 'Bearer ' + self.admin.token},
+            )
+        assert rv.status_code == 200
+        assert rv.json == [{'id': 1, 'centre': {'x': 750, 'y': 750}}]
+        assert not any('polygon_' in statement for statement in statements)
+
+    def test_get_markers_etag(self):
+        def get(map_id, etag=None):
+            headers = {'Authorization': 'Bearer ' + self.admin.token}
+            if etag:
+                headers['If-None-Match'] = etag
+            return self.client.get('/maps/{}/markers'.format(map_id), headers=headers)
+
+        etags = {map_id: get(map_id).headers['ETag'] for map_id in (1, 2)}
+        assert get(1, etags[1]).status_code == 304
+
+        rv = self.client.post(
+            '/maps/2/markers',
+            headers={'Authorization': 'Bearer ' + self.admin.token},
+            data={'polygon_json': '[{"x": 0, "y": 0}]'}
+        )
+        assert rv.status_code == 200
+        assert get(1, etags[1]).status_code == 304
+        rv = get(2, etags[2])
+        assert rv.status_code == 200
+        assert len(rv.json) == 1
+
+        rv = self.client.delete(
+            '/maps/2/markers/{}'.format(rv.json[0]['id']),
+            headers={'Authorization': 'Bearer ' + self.admin.token}
+        )
+        assert rv.status_code == 200
+        assert get(2, etags[2]).status_code == 200
+
+    def test_get_markers_bbox(self):
+        def get(bbox):
+            return self.client.get(
+                '/maps/1/markers?fields=id&bbox=' + bbox,
+                headers={'Authorization': 'Bearer ' + self.admin.token},
+            )
+        assert get('0,0,2000,2000').json == [{'id': 1}]
+        assert get('900,900,1200,1200').json == [{'id': 1}]
+        assert get('1000,0,1500,500').json == [{'id': 1}]
+        assert get('1001,0,1500,2000').json == []
+        assert get('0,0,499,2000').json == []
+        assert get('0,0,100').status_code == 400
+        assert get('10,0,0,10').status_code == 400
+
+    def test_get_markers_at(self):
+        def at(query, map_id=1):
+            return self.client.get(
+                '/maps/{}/markers/at?{}'.format(map_id, query),
+                headers={'Authorization': 'Bearer ' + self.admin.token},
+            )
+        rv = at('x=750&y=750')
+        assert rv.status_code == 200
+        assert [m['id'] for m in rv.json] == [1]
+        assert rv.json[0]['centre'] == {'x': 750, 'y': 750}
+        assert at('x=100&y=100').json == []
+        index = marker_indexes.get(1)
+
+        rv = self.client.post(
+            '/maps/1/markers',
+            headers={'Authorization': 'Bearer ' + self.admin.token},
+            data={'polygon_json': '[{"x": 0, "y": 0}, {"x": 200, "y": 0}, {"x": 0, "y": 200}]'}
+        )
+        marker_id = rv.json['id']
+        assert marker_indexes.get(1) is index
+        assert [m['id'] for m in at('x=50&y=50').json] == [marker_id]
+        assert at('x=150&y=150').json == []
+
+        rv = self.client.delete(
+            '/maps/1/markers/{}'.format(marker_id),
+            headers={'Authorization': 'Bearer ' + self.admin.token}
+        )
+        assert rv.status_code == 200
+        assert marker_indexes.get(1) is index
+        assert at('x=50&y=50').json == []
+
+        assert at('x=50').status_code == 400
+        assert at('x=inf&y=50').status_code == 400
+        assert at('x=50&y=nan').status_code == 400
+        assert at('x=50&y=50', map_id=54235).status_code == 404
+
+    def test_get_markers_simplified(self):
+        rv = self.client.post(
+            '/maps/2/markers',
+            headers={'Authorization': 'Bearer ' + self.admin.token},
+            data={'polygon_json': json.dumps(
+                [{'x': x, 'y': 0} for x in range(0, 1000, 5)] + [{'x': 1000, 'y': 1000}, {'x': 0, 'y': 1000}])}
+        )
+        assert rv.status_code == 200
+        marker_id = rv.json['id']
+        rv = self.client.get(
+            '/maps/2/markers?tolerance=4',
+            headers={'Authorization': 'Bearer ' + self.admin.token},
+        )
+        assert rv.status_code == 200
+        assert rv.json[0]['polygon'] == [{'x': 0, 'y': 0}, {'x': 995, 'y': 0}, {'x': 1000, 'y': 1000}, {'x': 0, 'y': 1000}]
+        assert rv.json[0]['centre'] == {'x': 498, 'y': 500}
+        rv = self.client.get(
+            '/maps/2/markers?tolerance=4&fields=id',
+            headers={'Authorization': 'Bearer ' + self.admin.token},
+        )
+        assert rv.json == [{'id': marker_id}]
+        for tolerance in ('inf', 'nan', '-1', '0'):
+            rv = self.client.get(
+                '/maps/2/markers?tolerance=' + tolerance,
+                headers={'Authorization': 'Bearer ' + self.admin.token},
+            )
+            assert rv.status_code == 400
+        rv = self.client.delete(
+            '/maps/2/markers/{}'.format(marker_id),
+            headers={'Authorization': 'Bearer ' + self.admin.token}
+        )
+        assert rv.status_code == 200
+
+    def post_batch(self, operations, map_id=2):
+        return self.client.post(
+            '/maps/{}/markers/batch'.format(map_id),
+            headers={'Authorization': 'Bearer ' + self.admin.token},
+            json={'operations': operations}
+        )
+
+    def test_marker_batch(self):
+        square = '[{"x": 0, "y": 0}, {"x": 100, "y": 0}, {"x": 100, "y": 100}, {"x": 0, "y": 100}]'
+        rv = self.post_batch([{'op': 'create', 'polygon_json': square}] * 3)
+        assert rv.status_code == 200
+        first, second, third = [m['id'] for m in rv.json['created']]
+        assert rv.json['created'][0]['centre'] == {'x': 50, 'y': 50}
+        index = marker_indexes.get(2)
+
+        db.session.expire_all()
+        with count_queries() as statements:
+            rv = self.post_batch([
+                {'op': 'create',
+                 'polygon_json': '[{"x": 500, "y": 500}, {"x": 600, "y": 500}, {"x": 500, "y": 600}]'},
+                {'op': 'update', 'id': first,
+                 'polygon_json': '[{"x": 200, "y": 200}, {"x": 300, "y": 200}, {"x": 200, "y": 300}]'},
+                {'op': 'update', 'id': second, 'project_id': 1},
+                {'op': 'delete', 'id': third},
+            ])
+        assert rv.status_code == 200
+        assert len(rv.json['created']) == 1
+        assert [m['id'] for m in rv.json['updated']] == [first, second]
+        assert rv.json['updated'][0]['centre'] == {'x': 233, 'y': 233}
+        assert rv.json['updated'][1]['project'] == {'id': 1, 'name': 'Test project'}
+        assert rv.json['deleted'] == [third]
+        assert len([s for s in statements if s.startswith('SELECT marker.')]) == 2
+        assert len([s for s in statements if s.startswith('UPDATE marker SET')]) == 2
+        assert Marker.query.get(third) is None
+
+        # the grid index is updated in place rather than rebuilt
+        assert marker_indexes.get(2) is index
+        assert index.query(50, 50) == [second]
+        assert index.query(210, 210) == [first]
+        assert index.query(510, 510) == [rv.json['created'][0]['id']]
+
+        self.post_batch([{'op': 'delete', 'id': marker_id}
+                         for marker_id in (first, second, rv.json['created'][0]['id'])])
+        assert Marker.query.filter(Marker.map_id == 2).count() == 0
+
+    def test_marker_batch_invalid(self):
+        rv = self.post_batch([
+            {'op': 'create', 'polygon_json': '[{"x": 0, "y": 0}]'},
+            {'op': 'create', 'polygon_json': 'damaged'},
+            {'op': 'update'},
+            {'op': 'move', 'id': 1},
+            {'op': 'create', 'polygon_json': '[{"x": 99999999999, "y": 0}]'},
+        ])
+        assert rv.status_code == 400
+        assert set(rv.json['message']) == {'1', '2', '3', '4'}
+        assert self.post_batch([{'op': 'delete', 'id': 54235}]).status_code == 404
+        assert self.post_batch([{'op': 'create', 'polygon_json': '[]'}], map_id=54235).status_code == 404
+        assert self.client.post(
+            '/maps/2/markers/batch',
+            headers={'Authorization': 'Bearer ' + self.student.token},
+            json={'operations': []}
+        ).status_code == 403
+        assert Marker.query.filter(Marker.map_id == 2).count() == 0
+
+    def test_marker_changes(self):
+        def changes(since, map_id=2, wait=None):
+            return self.client.get(
+                '/maps/{}/markers?fields=id,map_id&since={}{}'.format(
+                    map_id, since, '' if wait is None else '&wait={}'.format(wait)),
+                headers={'Authorization': 'Bearer ' + self.admin.token},
+            ).json
+        rv = changes(0)
+        assert rv['reset'] is True
+        assert rv['deletes'] == []
+        start = rv['seq']
+        assert changes(start) == {'seq': start, 'reset': False, 'upserts': [], 'deletes': []}
+
+        rv = self.client.post(
+            '/maps/2/markers',
+            headers={'Authorization': 'Bearer ' + self.admin.token},
+            data={'polygon_json': '[{"x": 0, "y": 0}, {"x": 10, "y": 0}, {"x": 0, "y": 10}]'}
+        )
+        marker_id = rv.json['id']
+        rv = changes(start)
+        assert rv['upserts'] == [{'id': marker_id, 'map_id': 2}]
+        assert rv['seq'] == start + 1
+        created = rv['seq']
+        assert changes(created)['upserts'] == []
+
+        # moving a marker removes it from the map it left
+        self.client.put(
+            '/maps/2/markers/{}'.format(marker_id),
+            headers={'Authorization': 'Bearer ' + self.admin.token},
+            data={'map_id': 1}
+        )
+        rv = changes(created)
+        assert rv['upserts'] == [] and rv['deletes'] == [marker_id]
+        assert {'id': marker_id, 'map_id': 1} in changes(created, map_id=1)['upserts']
+        moved = rv['seq']
+
+        self.client.delete(
+            '/maps/1/markers/{}'.format(marker_id),
+            headers={'Authorization': 'Bearer ' + self.admin.token}
+        )
+        rv = changes(moved, map_id=1)
+        assert rv['upserts'] == [] and rv['deletes'] == [marker_id]
+        assert changes(start)['deletes'] == [marker_id]
+
+        # long poll gives up after the wait without changes
+        self.app.config['MARKER_FEED_POLL_INTERVAL'] = 0.01
+        try:
+            assert changes(rv['seq'], wait=0.05)['upserts'] == []
+        finally:
+            self.app.config['MARKER_FEED_POLL_INTERVAL'] = 1.0
+        for wait in ('nan', 'inf', '-1'):
+            assert self.client.get(
+                '/maps/2/markers?since=1&wait=' + wait,
+                headers={'Authorization': 'Bearer ' + self.admin.token},
+            ).status_code == 400
+
+        # bulk statements cannot be replayed, clients have to start over
+        Marker.query.filter(Marker.id == marker_id) \
+            .update({Marker.project_id: None}, synchronize_session=False)
+        db.session.commit()
+        assert changes(rv['seq'])['reset'] is True
+        assert MarkerTombstone.query.count() == 0
+        assert self.client.get(
+            '/maps/2/markers?since=0&bbox=0,0,10,10',
+            headers={'Authorization': 'Bearer ' + self.admin.token},
+        ).status_code == 400
+
+    def test_marker_changes_from_project(self):
+        def changes(since):
+            return self.client.get(
+                '/maps/2/markers?fields=id,project_id,project&since={}'.format(since),
+                headers={'Authorization': 'Bearer ' + self.admin.token},
+            ).json
+        project = Project(name='Feed project')
+        db.session.add(project)
+        db.session.commit()
+        project_id = project.id
+        marker_id = self.client.post(
+            '/maps/2/markers',
+            headers={'Authorization': 'Bearer ' + self.admin.token},
+            data={'polygon_json': '[{"x": 0, "y": 0}, {"x": 10, "y": 0}, {"x": 0, "y": 10}]',
+                  'project_id': project_id}
+        ).json['id']
+        start = changes(0)['seq']
+
+        # markers embed the project name, so a rename is a marker change
+        self.client.put(
+            '/projects/{}'.format(project_id),
+            headers={'Authorization': 'Bearer ' + self.admin.token},
+            data={'name': 'Renamed project'}
+        )
+        rv = changes(start)
+        assert rv['upserts'] == [{'id': marker_id, 'project_id': project_id,
+                                  'project': {'id': project_id, 'name': 'Renamed project'}}]
+        renamed = rv['seq']
+
+        self.client.delete(
+            '/projects/{}'.format(project_id),
+            headers={'Authorization': 'Bearer ' + self.admin.token}
+        )
+        rv = changes(renamed)
+        assert [m['id'] for m in rv['upserts']] == [marker_id]
+        db.session.expire_all()
+        assert Marker.query.get(marker_id).project_id is None
+        assert rv['deletes'] == []
+
+        self.client.delete(
+            '/maps/2/markers/{}'.format(marker_id),
+            headers={'Authorization': 'Bearer ' + self.admin.token}
+        )
+
+    def test_response_cache(self):
+        def get():
+            return self.client.get(
+                '/maps/2/markers?fields=id',
+                headers={'Authorization': 'Bearer ' + self.admin.token},
+            ).json
+        response_cache.clear()
+        assert get() == []
+        assert get() == []
+        assert response_cache.stats()['hits'] == 1
+
+        # commits in this worker drop the map's responses
+        rv = self.client.post(
+            '/maps/2/markers',
+            headers={'Authorization': 'Bearer ' + self.admin.token},
+            data={'polygon_json': '[{"x": 0, "y": 0}, {"x": 10, "y": 0}, {"x": 0, "y": 10}]'}
+        )
+        marker_id = rv.json['id']
+        assert response_cache.stats()['size'] == 0
+        assert get() == [{'id': marker_id}]
+
+        # other workers only move the counters, the stale entry is not served
+        db.session.delete(Marker.query.get(marker_id))
+        db.session.flush()
+        db.session.info.pop('changed_counters')
+        db.session.commit()
+        assert response_cache.stats()['size'] == 1
+        assert get() == []
+
+        rv = self.client.get('/admin/cache_stats', headers={'Authorization': 'Bearer ' + self.admin.token})
+        assert rv.json['responses']['misses'] == 3
+
     def test_get_marker(self):
         rv = self.client.get(
             '/maps/1/markers/1',
@@ -214,3 +623,38 @@ class TestMarker(TestBase):
             headers={'Authorization': 'Bearer ' + self.admin.token},
         )
         assert rv.status_code == 404
+
+    def test_aggregates_consistent(self):
+        assert aggregates.differences(db.session.connection()) == []
+
+    def test_migrate_markers(self):
+        polygon = [{'x': 10, 'y': 10}, {'x': 30, 'y': 10}, {'x': 30, 'y': 30}]
+        table = Marker.__table__
+        result = db.session.execute(table.insert().values(map_id=2, polygon_json=json.dumps(polygon)))
+        invalid = db.session.execute(table.insert().values(map_id=2, polygon_json='[{"x": 1}]'))
+        db.session.commit()
+        marker_id, invalid_id = result.lastrowid, invalid.lastrowid
+        # the CLI runner ends with its own session teardown, get the token first
+        token = self.admin.token
+
+        def get_marker():
+            rv = self.client.get(
+                '/maps/2/markers/{}'.format(marker_id),
+                headers={'Authorization': 'Bearer ' + token}
+            )
+            assert rv.status_code == 200
+            return rv.json
+
+        before = get_marker()
+        result = self.app.test_cli_runner().invoke(markers, ['migrate', '--batch-size', '1'])
+        assert result.exit_code == 0
+        assert '1 markers converted, 1 left as JSON' in result.output
+        row = db.session.execute(table.select().where(table.c.id == marker_id)).first()
+        assert row.polygon_json is None
+        assert len(row.polygon_blob) == 24
+        assert (row.centre_x, row.centre_y) == (23, 16)
+        assert (row.min_x, row.min_y, row.max_x, row.max_y) == (10, 10, 30, 30)
+        assert get_marker() == before
+        assert before['polygon'] == polygon
+        db.session.execute(table.delete().where(table.c.id == invalid_id))
+        db.session.commit()
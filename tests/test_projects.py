@@ -1,6 +1,13 @@
+import csv
 import io
-from tests import TestBase
-from app.models import db, User, Map
+import json
+import time
+from sqlalchemy import event
+from tests import TestBase, count_queries, assert_num_queries
+from app.commands import rebuild_aggregates
+from app.models import db, User, Map, Marker, ProjectAggregate
+from app.utils import aggregates
+from app.common.cache import response_cache
 
 
 TESTING_CSV = b"""\
@@ -98,6 +105,14 @@ class TestProject(TestBase):
         assert rv.json['space_z'] == 2.5
         assert not rv.json['allocated']
 
+    def test_get_fields(self):
+        rv = self.client.get(
+            '/projects/{}?fields=name,allocated'.format(self.TEST_DATA['id']),
+            headers={'Authorization': 'Bearer ' + self.student.token}
+        )
+        assert rv.status_code == 200
+        assert rv.json == {'name': 'Project 1 NHB_Spatial Autonomy', 'allocated': False}
+
     def test_delete(self):
         rv = self.client.delete(
             '/projects/{}'.format(self.TEST_DATA['id']),
@@ -130,7 +145,60 @@ class TestProject(TestBase):
             content_type='multipart/form-data'
         )
         assert rv.status_code == 200
-        assert len(rv.json) == 5
+        assert rv.json['imported'] == 5
+        assert rv.json['failed'] == 0
+
+    def test_post_using_csv_line_endings(self):
+        upload = TESTING_CSV.split(b'\n')[0] + b'\nProject X, Prototype\n"multi\nline", Prototype\n'
+        for newline in (b'\r\n', b'\r'):
+            rv = self.client.post(
+                '/projects',
+                data={'file': (io.BytesIO(upload.replace(b'\n', newline)), 'test.csv')},
+                headers={'Authorization': 'Bearer ' + self.admin.token},
+                content_type='multipart/form-data'
+            )
+            assert rv.status_code == 200
+            assert rv.json['imported'] == 0
+            assert [e['first_line'] for e in rv.json['errors']] == [2, 4]
+
+    def test_post_using_csv_with_bad_row(self):
+        rv = self.client.post(
+            '/projects',
+            data={'file': (io.BytesIO(TESTING_CSV.split(b'\n')[0] + b'\nProject X, Prototype\n'), 'test.csv')},
+            headers={'Authorization': 'Bearer ' + self.admin.token},
+            content_type='multipart/form-data'
+        )
+        assert rv.status_code == 200
+        assert rv.json['imported'] == 0
+        assert rv.json['failed'] == 1
+        assert rv.json['errors'][0]['first_line'] == 2
+
+    def test_post_using_csv_async(self):
+        rv = self.client.post(
+            '/projects',
+            data={
+                'file': (io.BytesIO(TESTING_CSV.split(b'\n')[0] + b'\nProject X, Prototype\n'), 'test.csv'),
+                'async': 'true'
+            },
+            headers={'Authorization': 'Bearer ' + self.admin.token},
+            content_type='multipart/form-data'
+        )
+        assert rv.status_code == 202
+        job_url = rv.headers['Location']
+        for _ in range(100):
+            rv = self.client.get(job_url, headers={'Authorization': 'Bearer ' + self.admin.token})
+            assert rv.status_code == 200
+            if rv.json['status'] in ('finished', 'failed'):
+                break
+            time.sleep(0.05)
+        assert rv.json['status'] == 'finished'
+        assert rv.json['rows_processed'] == 1
+        assert rv.json['rows_failed'] == 1
+        assert rv.json['errors'][0]['first_line'] == 2
+
+    def test_get_import_job_not_found(self):
+        rv = self.client.get('/imports/54235', headers={'Authorization': 'Bearer ' + self.admin.token})
+        assert rv.status_code == 404
 
     def test_get_list(self):
         rv = self.client.get('/projects', headers={'Authorization': 'Bearer ' + self.admin.token})
@@ -141,6 +209,85 @@ class TestProject(TestBase):
             assert rv.json[i]['space_x'] == 5
             assert rv.json[i]['space_y'] == 4
 
+    def test_get_list_etag(self):
+        rv = self.client.get('/projects', headers={'Authorization': 'Bearer ' + self.admin.token})
+        etag = rv.headers['ETag']
+        rv = self.client.get('/projects', headers={
+            'Authorization': 'Bearer ' + self.admin.token,
+            'If-None-Match': etag
+        })
+        assert rv.status_code == 304
+        rv = self.client.get('/projects?fields=id', headers={
+            'Authorization': 'Bearer ' + self.admin.token,
+            'If-None-Match': etag
+        })
+        assert rv.status_code == 200
+        rv = self.client.get('/projects', headers={
+            'Authorization': 'Bearer ' + self.student.token,
+            'If-None-Match': etag
+        })
+        assert rv.status_code == 200
+
+        rv = self.client.put(
+            '/projects/1',
+            headers={'Authorization': 'Bearer ' + self.admin.token},
+            data={'remark': 'Remark1 (edited)'}
+        )
+        assert rv.status_code == 200
+        rv = self.client.get('/projects', headers={
+            'Authorization': 'Bearer ' + self.admin.token,
+            'If-None-Match': etag
+        })
+        assert rv.status_code == 200
+        assert rv.headers['ETag'] != etag
+
+    def test_get_list_fields(self):
+        rv = self.client.get(
+            '/projects?fields=id,name',
+            headers={'Authorization': 'Bearer ' + self.admin.token}
+        )
+        assert rv.status_code == 200
+        assert len(rv.json) == 5
+        for project in rv.json:
+            assert set(project) == {'id', 'name'}
+
+    def test_get_list_unknown_field(self):
+        rv = self.client.get(
+            '/projects?fields=id,password',
+            headers={'Authorization': 'Bearer ' + self.admin.token}
+        )
+        assert rv.status_code == 400
+
+    def test_get_list_paginated(self):
+        for sort in ('id', 'updated_on'):
+            names = []
+            cursor = None
+            while True:
+                data = {'limit': 2, 'count': 'true', 'sort': sort}
+                if cursor:
+                    data['cursor'] = cursor
+                rv = self.client.get(
+                    '/projects',
+                    data=data,
+                    headers={'Authorization': 'Bearer ' + self.admin.token}
+                )
+                assert rv.status_code == 200
+                assert len(rv.json) <= 2
+                assert rv.headers['X-Total-Count'] == '5'
+                names += [p['name'] for p in rv.json]
+                cursor = rv.headers.get('X-Next-Cursor')
+                if not cursor:
+                    break
+            assert sorted(names) == ['Project {}'.format(i + 1) for i in range(5)]
+
+    def test_get_list_invalid_cursor(self):
+        rv = self.client.get(
+            '/projects',
+            data={'cursor': 'not a cursor'},
+            headers={'Authorization': 'Bearer ' + self.admin.token}
+        )
+        assert rv.status_code == 400
+
     def test_filter_by_name(self):
         rv = self.client.get(
             '/projects',
@@ -151,10 +298,20 @@ class TestProject(TestBase):
         assert len(rv.json) == 1
         assert rv.json[0]['name'] == 'Project 3'
 
+    def test_filter_by_name_max_code_point(self):
+        for name in ('Project 3' + chr(0x10FFFF), chr(0x10FFFF), 'Project 3' + chr(0xD7FF)):
+            rv = self.client.get(
+                '/projects',
+                data={'name': name},
+                headers={'Authorization': 'Bearer ' + self.admin.token}
+            )
+            assert rv.status_code == 200
+            assert rv.json == []
+
     def test_filter_by_remark(self):
         rv = self.client.get(
             '/projects',
-            data={'remark': 'Remark4'},
+            data={'remark__contains': 'Remark4'},
             headers={'Authorization': 'Bearer ' + self.admin.token}
         )
         assert rv.status_code == 200
@@ -176,7 +333,7 @@ class TestProject(TestBase):
             '/projects',
             data={
                 'name': 'Project',
-                'type': 'ro',
+                'type__contains': 'ro',
                 'prototype_x': '0.2'
             },
             headers={'Authorization': 'Bearer ' + self.admin.token}
@@ -185,6 +342,23 @@ class TestProject(TestBase):
         assert len(rv.json) == 1
         assert rv.json[0]['name'] == 'Project 5'
 
+    def test_filter_by_range(self):
+        rv = self.client.get(
+            '/projects',
+            data={'space_z__gt': '2.5', 'name': 'Proj'},
+            headers={'Authorization': 'Bearer ' + self.admin.token}
+        )
+        assert rv.status_code == 200
+        assert [p['name'] for p in rv.json] == ['Project 2']
+
+    def test_filter_invalid_number(self):
+        rv = self.client.get(
+            '/projects',
+            data={'space_x__lte': 'five'},
+            headers={'Authorization': 'Bearer ' + self.admin.token}
+        )
+        assert rv.status_code == 400
+
     def test_allocation(self):
         rv = self.client.post(
             '/admin/run_allocation',
@@ -238,6 +412,126 @@ class TestProject(TestBase):
             marker_count += len(rv.json)
         assert marker_count == self.TEST_DATA['project_count'] - self.TEST_DATA['skipped_count']
 
+    def test_get_list_query_count(self):
+        token = self.admin.token
+        db.session.expire_all()
+        # user, ETag validators (project version, marker counter), projects, their markers
+        with assert_num_queries(5):
+            rv = self.client.get('/projects', headers={'Authorization': 'Bearer ' + token})
+        assert rv.status_code == 200
+        assert len(rv.json) > 5
+        assert any(project['allocated'] for project in rv.json)
+        db.session.expire_all()
+        with assert_num_queries(5):
+            rv = self.client.get('/projects?limit=20', headers={'Authorization': 'Bearer ' + token})
+        assert rv.status_code == 200
+
+    def test_get_markers_query_count(self):
+        token = self.admin.token
+        response_cache.clear()
+        db.session.expire_all()
+        # user, ETag validators (marker counters, project version), map, markers joined to projects
+        with assert_num_queries(5):
+            rv = self.client.get('/maps/1/markers', headers={'Authorization': 'Bearer ' + token})
+        assert rv.status_code == 200
+        assert len(rv.json) > 5
+        assert all(marker['project']['name'] for marker in rv.json)
+
+        # served from the response cache once the validators match
+        db.session.expire_all()
+        with assert_num_queries(3):
+            cached = self.client.get('/maps/1/markers', headers={'Authorization': 'Bearer ' + token})
+        assert cached.json == rv.json
+
+    def test_aggregates(self):
+        rv = self.client.get('/projects/aggregates', headers={'Authorization': 'Bearer ' + self.admin.token})
+        assert rv.status_code == 200
+        assert rv.json['total']['project_count'] == self.TEST_DATA['project_count']
+        assert sum(t['project_count'] for t in rv.json['types']) == self.TEST_DATA['project_count']
+        assert sum(m['project_count'] for m in rv.json['maps']) == \
+            self.TEST_DATA['project_count'] - self.TEST_DATA['skipped_count']
+        for m in rv.json['maps']:
+            assert m['map_name'].startswith('Campus Centre Level')
+        assert aggregates.differences(db.session.connection()) == []
+
+        rv = self.client.get('/projects/aggregates', headers={'Authorization': 'Bearer ' + self.student.token})
+        assert rv.status_code == 403
+
+    def test_aggregates_created_concurrently(self):
+        table = ProjectAggregate.__table__
+        raced = []
+
+        def insert_first(conn, cursor, statement, parameters, context, executemany):
+            # another transaction creates the row right after our UPDATE missed it
+            if not raced and statement.startswith('UPDATE project_aggregate') and cursor.rowcount == 0:
+                raced.append(statement)
+                conn.execute(table.insert().values(
+                    scope='type', name='Concurrent', **{c: 1 for c in aggregates.METRICS}))
+
+        connection = db.session.connection()
+        event.listen(db.engine, 'after_cursor_execute', insert_first)
+        try:
+            aggregates.apply(connection, {}, {0: ('Concurrent', aggregates.project_values(2, 3), [])})
+            row = connection.execute(table.select().where(table.c.name == 'Concurrent')).first()
+        finally:
+            event.remove(db.engine, 'after_cursor_execute', insert_first)
+            db.session.rollback()
+        assert raced
+        assert (row.project_count, row.floor_area) == (2, 7)
+
+    def test_export_csv(self):
+        rv = self.client.get('/projects/export', headers={'Authorization': 'Bearer ' + self.admin.token})
+        assert rv.status_code == 200
+        assert rv.mimetype == 'text/csv'
+        rows = list(csv.DictReader(io.StringIO(rv.get_data(as_text=True))))
+        assert len(rows) == self.TEST_DATA['project_count']
+        allocated = [row for row in rows if row['allocated'] == 'True']
+        assert len(allocated) == self.TEST_DATA['project_count'] - self.TEST_DATA['skipped_count']
+        for row in allocated:
+            assert row['map_name'].startswith('Campus Centre Level')
+            assert row['centre_x'] and row['centre_y']
+
+    def test_export_legacy_markers(self):
+        def export():
+            rv = self.client.get('/projects/export', headers={'Authorization': 'Bearer ' + token})
+            return list(csv.DictReader(io.StringIO(rv.get_data(as_text=True))))
+        token = self.admin.token
+        expected = export()
+        # markers written before the centre columns existed
+        db.session.execute(Marker.__table__.update().values(centre_x=None, centre_y=None))
+        db.session.expire_all()
+        try:
+            with count_queries() as statements:
+                rows = export()
+        finally:
+            db.session.rollback()
+        assert rows == expected
+        assert any(row['allocated'] == 'True' for row in rows)
+        assert len([s for s in statements if 'marker' in s]) == 1
+
+    def test_export_ndjson(self):
+        rv = self.client.get(
+            '/projects/export?format=ndjson',
+            headers={'Authorization': 'Bearer ' + self.admin.token}
+        )
+        assert rv.status_code == 200
+        assert rv.mimetype == 'application/x-ndjson'
+        rows = [json.loads(line) for line in rv.get_data(as_text=True).splitlines()]
+        assert len(rows) == self.TEST_DATA['project_count']
+        assert rows == sorted(rows, key=lambda row: row['id'])
+        for row in rows:
+            assert row['allocated'] == (row['marker_id'] is not None)
+            assert isinstance(row['updated_on'], str)
+
+    def test_export_forbidden(self):
+        rv = self.client.get('/projects/export', headers={'Authorization': 'Bearer ' + self.student.token})
+        assert rv.status_code == 403
+        rv = self.client.get(
+            '/projects/export?format=xml',
+            headers={'Authorization': 'Bearer ' + self.admin.token}
+        )
+        assert rv.status_code == 400
+
     def test_send_notifications(self):
         rv = self.client.post(
             '/admin/send_notifications',
@@ -245,19 +539,87 @@ class TestProject(TestBase):
         )
         assert rv.status_code == 200
 
-    def test_bunch_delete(self):
+    def test_bulk_patch(self):
         rv = self.client.get('/projects', headers={'Authorization': 'Bearer ' + self.admin.token})
-        assert rv.status_code == 200
         project_ids = [p['id'] for p in rv.json]
-        to_be_deleted = list(filter(lambda i: i % 2, project_ids))
+        token = self.admin.token
+        with count_queries() as statements:
+            rv = self.client.patch(
+                '/projects',
+                headers={'Authorization': 'Bearer ' + token},
+                json={'ids': project_ids, 'type': 'Bulk', 'table_count': 2}
+            )
+        assert rv.status_code == 200
+        assert rv.json['updated'] == len(project_ids)
+        assert len([s for s in statements if s.startswith('UPDATE project SET')]) == 1
+        rv = self.client.get('/projects', headers={'Authorization': 'Bearer ' + self.admin.token})
+        for project in rv.json:
+            assert project['type'] == 'Bulk'
+            assert project['table_count'] == 2
+
+    def test_bulk_patch_invalid(self):
+        rv = self.client.patch(
+            '/projects',
+            headers={'Authorization': 'Bearer ' + self.admin.token},
+            json={'ids': [1]}
+        )
+        assert rv.status_code == 400
+        rv = self.client.patch(
+            '/projects',
+            headers={'Authorization': 'Bearer ' + self.admin.token},
+            json={'ids': [1, 54235], 'type': 'Missing'}
+        )
+        assert rv.status_code == 404
+        rv = self.client.get('/projects/1', headers={'Authorization': 'Bearer ' + self.admin.token})
+        assert rv.json['type'] != 'Missing'
+        rv = self.client.patch(
+            '/projects',
+            headers={'Authorization': 'Bearer ' + self.student.token},
+            json={'ids': [1], 'type': 'Student'}
+        )
+        assert rv.status_code == 403
+
+    def test_bunch_delete_missing(self):
         rv = self.client.delete(
             '/projects',
             headers={'Authorization': 'Bearer ' + self.admin.token},
-            json={'ids': to_be_deleted}
+            json={'ids': [1, 54235]}
         )
+        assert rv.status_code == 404
+        assert 'Project 54235 not found' == rv.json['message']
+        rv = self.client.get('/projects/1', headers={'Authorization': 'Bearer ' + self.admin.token})
+        assert rv.status_code == 200
+
+    def test_bunch_delete(self):
+        rv = self.client.get('/projects', headers={'Authorization': 'Bearer ' + self.admin.token})
+        assert rv.status_code == 200
+        project_ids = [p['id'] for p in rv.json]
+        to_be_deleted = list(filter(lambda i: i % 2, project_ids))
+        token = self.admin.token
+        with count_queries() as statements:
+            rv = self.client.delete(
+                '/projects',
+                headers={'Authorization': 'Bearer ' + token},
+                json={'ids': to_be_deleted}
+            )
         assert rv.status_code == 200
+        assert len([s for s in statements if s.startswith('DELETE FROM project WHERE')]) == 1
         rv = self.client.get('/projects', headers={'Authorization': 'Bearer ' + self.admin.token})
         assert rv.status_code == 200
         for project in rv.json:
             assert project['id'] in project_ids
             assert project['id'] not in to_be_deleted
+        assert Marker.query.filter(Marker.project_id.in_(to_be_deleted)).count() == 0
+
+    def test_aggregates_after_bulk_changes(self):
+        assert aggregates.differences(db.session.connection()) == []
+        runner = self.app.test_cli_runner()
+        assert runner.invoke(rebuild_aggregates, ['--check']).exit_code == 0
+
+        ProjectAggregate.query.filter_by(scope='total').update({'monitor_count': -1})
+        db.session.commit()
+        result = runner.invoke(rebuild_aggregates, ['--check'])
+        assert result.exit_code != 0
+        assert 'total' in result.output
+        assert runner.invoke(rebuild_aggregates).exit_code == 0
+        assert aggregates.differences(db.session.connection()) == []
@@ -0,0 +1,61 @@
+import datetime
+from flask_restful import fields, marshal
+from app.common.serializer import compile_fields, serializer_for
+from app.models import User, Project, Marker, Map
+from app.resources.map import map_field
+from app.resources.marker import marker_field
+from app.resources.project import project_fields, import_result_fields
+from app.resources.user import user_fields
+
+
+def sample_projects():
+    allocated = Project(id=1, name='Allocated', type='Prototype', space_x=5, space_y=4,
+                        updated_on=datetime.datetime(2020, 3, 1, 12, 30), monitor_count=2)
+    allocated.marker = Marker(id=1, polygon=[{'x': 0, 'y': 0}, {'x': 10, 'y': 0}, {'x': 10, 'y': 10}])
+    return [allocated, Project(id=2, name='Empty'), Project()]
+
+
+def sample_markers():
+    polygon = [{'x': 0, 'y': 0}, {'x': 100, 'y': 0}, {'x': 100, 'y': 100}, {'x': 0, 'y': 100}]
+    return [
+        Marker(id=1, map_id=1, polygon=polygon, project=Project(id=3, name='Booth')),
+        Marker(id=2, map_id=1, polygon=polygon),
+    ]
+
+
+class TestSerializer:
+    def test_projects(self):
+        projects = sample_projects()
+        assert compile_fields(project_fields)(projects) == marshal(projects, project_fields)
+
+    def test_markers(self):
+        markers = sample_markers()
+        assert compile_fields(marker_field)(markers) == marshal(markers, marker_field)
+
+    def test_maps_and_users(self):
+        maps = [Map(id=1, name='Level 1', url='https://example.com', level=1, scale=0.025), Map()]
+        users = [User(id=1, email='a@example.com', full_name='A', is_admin=True), User()]
+        assert compile_fields(map_field)(maps) == marshal(maps, map_field)
+        assert compile_fields(user_fields)(users) == marshal(users, user_fields)
+
+    def test_single_object_and_dict(self):
+        result = {'imported': 1, 'failed': 0, 'errors': [{'first_line': 2, 'message': 'x'}]}
+        assert compile_fields(import_result_fields)(result) == marshal(result, import_result_fields)
+        project = sample_projects()[0]
+        assert compile_fields(project_fields)(project) == marshal(project, project_fields)
+
+    def test_fallback_on_error(self):
+        fields_with_int = {'id': fields.Integer, 'name': fields.String}
+        project = Project(id=1, name='x')
+        project.id = 'not a number'
+        try:
+            compile_fields(fields_with_int)(project)
+            assert False, 'expected the same error as marshal'
+        except Exception as e:
+            assert type(e).__name__ == 'MarshallingException'
+
+    def test_serializer_for_subset(self):
+        subset = {k: project_fields[k] for k in ('id', 'name')}
+        assert serializer_for(subset) is serializer_for(dict(subset))
+        projects = sample_projects()
+        assert serializer_for(subset)(projects) == marshal(projects, subset)
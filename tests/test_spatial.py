@@ -0,0 +1,53 @@
+import random
+import time
+from app.utils import geometry
+from app.utils.spatial import GridIndex, contains
+
+
+def coords(points):
+    return geometry.unpack(geometry.pack({'x': x, 'y': y} for x, y in points))
+
+
+class TestSpatial:
+    def test_contains(self):
+        square = coords([(0, 0), (10, 0), (10, 10), (0, 10)])
+        assert contains(square, 5, 5)
+        assert not contains(square, 15, 5)
+        concave = coords([(0, 0), (10, 0), (10, 10), (5, 5), (0, 10)])
+        assert contains(concave, 2, 6)
+        assert not contains(concave, 5, 8)
+        assert not contains(coords([]), 0, 0)
+
+    def test_grid_matches_brute_force(self):
+        random.seed(21)
+        index = GridIndex(cell_size=50)
+        polygons = {}
+        for marker_id in range(200):
+            x, y = random.randint(0, 2000), random.randint(0, 2000)
+            w, h = random.randint(5, 300), random.randint(5, 300)
+            polygons[marker_id] = coords([(x, y), (x + w, y), (x + w, y + h), (x, y + h)])
+            index.insert(marker_id, polygons[marker_id])
+        for marker_id in range(0, 200, 3):
+            index.remove(marker_id)
+            del polygons[marker_id]
+        assert len(index) == len(polygons)
+        for _ in range(500):
+            x, y = random.uniform(0, 2300), random.uniform(0, 2300)
+            expected = sorted(i for i, c in polygons.items() if contains(c, x, y))
+            assert index.query(x, y) == expected
+
+    def test_grid_huge_polygon(self):
+        index = GridIndex(cell_size=256, max_cells=16)
+        limit = geometry.COORDINATE_MAX
+        started = time.monotonic()
+        index.insert(1, coords([(-limit, -limit), (limit, -limit), (limit, limit)]))
+        index.insert(2, coords([(0, 0), (100, 0), (100, 100), (0, 100)]))
+        assert time.monotonic() - started < 1
+        assert index.overflow == {1}
+        assert index.query(50, 40) == [1, 2]
+        assert index.query(-limit + 10, limit - 10) == []
+        assert index.query(limit - 10, limit - 100) == [1]
+        index.remove(1)
+        assert index.overflow == set()
+        assert index.query(50, 40) == [2]
+        assert len(index) == 1
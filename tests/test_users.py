@@ -1,5 +1,14 @@
+import os
+import tempfile
 from base64 import b64encode
+from passlib.context import CryptContext
+from passlib.hash import sha256_crypt
 from tests import TestBase, mutator
+from app.commands import calibrate_hashing
+from app.models import db, User
+from app.common.cache import credential_cache
+from app.common.hashing import password_hasher
+from app.common.ratelimit import login_limiter
 
 
 def gen_authorization(username, password):
@@ -69,6 +78,17 @@ class TestUser(TestBase):
         assert 'token' in rv.json
         self.TEST_ACCOUNT['token'] = rv.json['token']
 
+    def test_login_password_cached(self):
+        hits = credential_cache.stats()['hits']
+        rv = self.client.get('/users/current', headers={
+            'Authorization': gen_authorization(
+                self.TEST_ACCOUNT['email'],
+                self.TEST_ACCOUNT['password']
+            )
+        })
+        assert rv.status_code == 200
+        assert credential_cache.stats()['hits'] == hits + 1
+
     def test_login_password_empty(self):
         rv = self.client.get('/users/current', headers={
             'Authorization': gen_authorization('', '')
@@ -85,6 +105,26 @@ class TestUser(TestBase):
             })
             assert rv.status_code == 401
 
+    def test_login_hashing_saturated(self):
+        pending = password_hasher._pending
+        password_hasher._pending = password_hasher.queue_limit
+        try:
+            rv = self.client.get('/users/current', headers={
+                'Authorization': gen_authorization(
+                    self.TEST_ACCOUNT['email'],
+                    'not' + self.TEST_ACCOUNT['password']
+                )
+            })
+        finally:
+            password_hasher._pending = pending
+        assert rv.status_code == 503
+        assert 'Retry-After' in rv.headers
+
+    def test_hashing_pool_started_with_app(self):
+        # workers are forked by init_app, never from a request thread
+        processes = password_hasher._executor._processes
+        assert len(processes) == self.app.config['PASSWORD_HASH_WORKERS']
+
     def test_login_wrong_email(self):
         for _ in range(5):
             rv = self.client.get('/users/current', headers={
@@ -95,12 +135,64 @@ class TestUser(TestBase):
             })
             assert rv.status_code == 401
 
+    def test_login_throttled(self):
+        for _ in range(self.app.config['LOGIN_RATE_LIMIT_EMAIL_BURST']):
+            rv = self.client.get('/users/current', headers={
+                'Authorization': gen_authorization('attacker@example.com', 'guess')
+            })
+            assert rv.status_code == 401
+        rv = self.client.get('/users/current', headers={
+            'Authorization': gen_authorization('attacker@example.com', 'guess')
+        })
+        assert rv.status_code == 429
+        assert int(rv.headers['Retry-After']) > 0
+
+    def test_login_not_throttled_on_success(self):
+        for _ in range(self.app.config['LOGIN_RATE_LIMIT_EMAIL_BURST'] + 5):
+            rv = self.client.get('/users/current', headers={
+                'Authorization': gen_authorization(
+                    self.TEST_ACCOUNT['email'],
+                    self.TEST_ACCOUNT['password']
+                )
+            })
+            assert rv.status_code == 200
+
+    def test_login_address_throttled_with_successes(self):
+        limits = dict(login_limiter.limits)
+        login_limiter.limits['address'] = (4, 1 / 3600)
+        environ = {'REMOTE_ADDR': '203.0.113.7'}
+        try:
+            statuses = []
+            for i in range(8):
+                email, password = (self.TEST_ACCOUNT['email'], self.TEST_ACCOUNT['password']) if i % 2 \
+                    else ('victim{}@example.com'.format(i), 'guess')
+                rv = self.client.get('/users/current', environ_base=environ, headers={
+                    'Authorization': gen_authorization(email, password)
+                })
+                statuses.append(rv.status_code)
+        finally:
+            login_limiter.limits = limits
+        # own successful logins do not refill the address bucket
+        assert statuses[:4] == [401, 200, 401, 200]
+        assert statuses[4:] == [429] * 4
+
     def test_login_token(self):
         rv = self.client.get('/users/current', headers={
             'Authorization': 'Bearer ' + self.TEST_ACCOUNT['token']
         })
         assert rv.status_code == 200
 
+    def test_login_token_stateless(self):
+        self.app.config['STATELESS_TOKEN_AUTH'] = True
+        try:
+            rv = self.client.get('/users/current', headers={
+                'Authorization': 'Bearer ' + self.TEST_ACCOUNT['token']
+            })
+        finally:
+            self.app.config['STATELESS_TOKEN_AUTH'] = False
+        assert rv.status_code == 200
+        assert rv.json['email'] == self.TEST_ACCOUNT['email']
+
     def test_login_token_wrong(self):
         for _ in range(100):
             # \r and \n are logically not allowed in header
@@ -161,8 +253,24 @@ class TestUser(TestBase):
             headers={'Authorization': 'Bearer ' + self.TEST_ACCOUNT['token']}
         )
         assert rv.status_code == 200
+        self.TEST_ACCOUNT['old_password'] = self.TEST_ACCOUNT['password']
         self.TEST_ACCOUNT['password'] = new_password
 
+    def test_login_token_after_password_change(self):
+        rv = self.client.get('/users/current', headers={
+            'Authorization': 'Bearer ' + self.TEST_ACCOUNT['token']
+        })
+        assert rv.status_code == 401
+
+    def test_login_with_old_password(self):
+        rv = self.client.get('/users/current', headers={
+            'Authorization': gen_authorization(
+                self.TEST_ACCOUNT['email'],
+                self.TEST_ACCOUNT['old_password']
+            )
+        })
+        assert rv.status_code == 401
+
     def test_login_with_new_password(self):
         rv = self.client.get('/users/current', headers={
             'Authorization': gen_authorization(
@@ -171,3 +279,31 @@ class TestUser(TestBase):
             )
         })
         assert rv.status_code == 200
+
+    def test_rehash_on_login(self):
+        user = User(
+            email='legacy@example.com',
+            password_hash=sha256_crypt.using(rounds=1000).hash('legacypassword'),
+            full_name='Legacy Account'
+        )
+        db.session.add(user)
+        db.session.commit()
+        rv = self.client.get('/users/current', headers={
+            'Authorization': gen_authorization('legacy@example.com', 'legacypassword')
+        })
+        assert rv.status_code == 200
+        user = User.query.filter_by(email='legacy@example.com').first()
+        assert user.password_hash.startswith('$6$')
+        assert user.verify_password('legacypassword')
+
+    def test_calibrate_hashing(self):
+        fd, output = tempfile.mkstemp(suffix='.ini')
+        os.close(fd)
+        try:
+            result = self.app.test_cli_runner().invoke(
+                calibrate_hashing, ['--target-ms', '5', '--output', output])
+            assert result.exit_code == 0
+            context = CryptContext.from_path(output)
+            assert context.default_scheme() == 'sha512_crypt'
+        finally:
+            os.remove(output)